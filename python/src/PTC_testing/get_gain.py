@@ -1,9 +1,8 @@
 import os
 import sys
 sys.path.append(r"C:\Users\vidar\OneDrive - University of Bristol\Documents\Uni_2021_2022\MAPS_experiment\code\python_old\src")
-import pickle
 import ptc_tools
-from scipy.optimize import curve_fit
+import smooth_tools
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -12,43 +11,23 @@ gainpath = r"C:\Users\vidar\OneDrive - University of Bristol\Documents\Uni_2021_
 fullpath = r"C:\Users\vidar\OneDrive - University of Bristol\Documents\Uni_2021_2022\MAPS_experiment\code\python_old\lib\Full_well"
 noisepath= r"C:\Users\vidar\OneDrive - University of Bristol\Documents\Uni_2021_2022\MAPS_experiment\code\python_old\lib\Read_noise"
 
-def fit_func(x, a, b):
-    return a*x + b
-
-
 def fit_curve(ptc, cutoff):
-    shape = ptc.s_mean.shape
-    parameters = np.zeros([2, *shape[1:]], dtype=float)
-    for i in range(520):
-        print(i)
-        for j in range(520):
-            if cutoff[i, j] >= 2:
-                parameters[:, i, j] = curve_fit(fit_func, 
-                                                  ptc.s_mean[:cutoff[i, j], i, j],
-                                                  ptc.err_tot[:cutoff[i, j], i, j])[0]
+    parameters, errors, residuals = ptc_tools.fit_ptc(ptc, cutoff)
     gain = 1/parameters[0]
     read_noise = parameters[1]
     return (gain, read_noise)
 
 
+def fit_errors(ptc, cutoff):
+    parameters, errors, residuals = ptc_tools.fit_ptc(ptc, cutoff)
+    gain_err = errors[0]/np.square(parameters[0])
+    read_noise_err = errors[1]
+    return (gain_err, read_noise_err, residuals)
+
+
 def get_peak(ptc, smooth=3):
     print("Smoothing over {} frames".format(smooth))
-    shape = ptc.err_tot.shape
-    array = ptc.err_tot.reshape(shape[0], -1)
-    n_points = array.shape[1]
-    for i in range(n_points):
-        frame_avg = np.zeros(shape[0], dtype=float)
-        for j in range(2*smooth + 1):
-            k = i + j - smooth
-            if k < 0:
-                k = 0
-            elif k > n_points - 1:
-                k = n_points - 1
-            frame_avg += array[:, k]
-        frame_avg /= 2*smooth + 1
-        array[:, i] = frame_avg
-    array = array.reshape(shape)
-    return array.argmax(axis=0)
+    return smooth_tools.find_peak(ptc.view("err_tot"), smooth=smooth, axis=0)
 
 
 def save_arr(array, arr_name, savepath):
@@ -68,8 +47,7 @@ def save_arr(array, arr_name, savepath):
 
 if __name__ == "__main__":
     # get ptc put into ptc variable
-    with open(filepath, "rb") as file:
-        ptc = pickle.load(file)
+    ptc = ptc_tools.load_ptc_object(filepath)
     peak = get_peak(ptc)
     gain, read_noise = fit_curve(ptc, peak)
     # bad_coords = np.where(abs(gain) > 200)
@@ -2,9 +2,9 @@ import os
 import sys
 
 sys.path.append(r"C:\Users\vidar\OneDrive - University of Bristol\Documents\Uni_2021_2022\MAPS_experiment\code\python_old\src")
-import pickle
 import matplotlib.pyplot as plt
 import ptc_tools
+import smooth_tools
 
 def graph_err_tot(ptc, axes, pixel, colour="g"):
     """
@@ -23,20 +23,9 @@ def graph_err_tot(ptc, axes, pixel, colour="g"):
 
 
 def graph_err_smooth(ptc, axes, pixel, smooth=1, colour="r"):
-    smootherr = ptc.err_tot[:, pixel[0], pixel[1]]
-    n_frames = smootherr.shape[0]
-    for i in range(n_frames):
-            frame_avg = 0
-            for j in range(2*smooth + 1):
-                k = i + j - smooth
-                if k < 0:
-                    k = 0
-                elif k > n_frames - 1:
-                    k = n_frames - 1
-                frame_avg += smootherr[k]
-            frame_avg /= 2*smooth + 1
-            smootherr[i] = frame_avg
-    axes.plot(ptc.s_mean[:, pixel[0], pixel[1]], smootherr, color=colour, label="Total noise (smoothed)")
+    smootherr = smooth_tools.moving_average(\
+        ptc.view("err_tot")[:, pixel[0], pixel[1]], smooth)
+    axes.plot(ptc.view("s_mean")[:, pixel[0], pixel[1]], smootherr, color=colour, label="Total noise (smoothed)")
 
 
 def graph_ptc(ptc):
@@ -131,10 +120,10 @@ def graph_ptc(ptc):
 if __name__ == "__main__":
     print("Please enter path to PTC curve")
     ptc_path = input()
-    if os.path.isfile(ptc_path) == True:
+    if os.path.exists(ptc_path) == True:
         print("Recived path to run ptc object\n")
-        with open(ptc_path, "rb") as file:
-            ptc = pickle.load(file)
+        # Memory mapped, only the plotted pixel is read
+        ptc = ptc_tools.load_ptc_object(ptc_path)
         print("PTC \"{}\" successfully loaded")
     else:
         print("Invalid path")
@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import uuid
+import socket
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pipeline
+
+LOCK_NAME = ".lock"
+DONE_NAME = "summary.json"
+HEARTBEAT = 30
+STALE_AFTER = 600
+
+
+class JobLock():
+    """
+    Claims a sensor for one process on any machine sharing the filesystem.
+    The lock is a file created with O_EXCL in the sensor's output directory
+    holding a token unique to its owner, whose modification time is refreshed
+    by a heartbeat thread while the job runs. A lock that has not been
+    refreshed for stale_after seconds belongs to a process that died and is
+    taken over. Its age is measured against the modification time of a probe
+    file written next to it, so only the file server's clock is used.
+    """
+
+    def __init__(self, dirpath, heartbeat=HEARTBEAT, stale_after=STALE_AFTER):
+        """
+        Args:
+            dirpath: str, output directory of the job
+
+            heartbeat: float, seconds between refreshes of the lock
+
+            stale_after: float, seconds after which a lock that is not
+                refreshed is broken
+        """
+        self.path = os.path.join(dirpath, LOCK_NAME)
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.stop = threading.Event()
+        self.thread = None
+        self.token = "{}:{}:{}".format(socket.gethostname(), os.getpid(), \
+            uuid.uuid4().hex)
+
+    def acquire(self):
+        """
+        Returns: bool; True if the lock was claimed by this process
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.take_over():
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(self.token)
+            self.thread = threading.Thread(target=self.beat, daemon=True)
+            self.thread.start()
+            return True
+        return False
+
+    def take_over(self):
+        """
+        Removes the lock if it is stale. The lock is first renamed to a name
+        unique to this process, which only one contender can do, and then
+        checked again, so a lock that was refreshed or replaced in between is
+        put back rather than removed.
+
+        Returns: bool; True if the lock is gone and can be claimed
+        """
+        owner, age = self.inspect(self.path)
+        if owner == None:
+            # Released in the meantime
+            return True
+        if age < self.stale_after:
+            return False
+        taken = "{}.{}".format(self.path, self.token.replace(":", "_"))
+        try:
+            os.rename(self.path, taken)
+        except FileNotFoundError:
+            return True
+        taken_owner, taken_age = self.inspect(taken)
+        if taken_owner == owner and taken_age >= self.stale_after:
+            print("Breaking stale lock \"{}\" of \"{}\"".format(self.path, \
+                owner))
+            os.remove(taken)
+            return True
+        try:
+            # No overwrite, a lock claimed since is left alone
+            os.link(taken, self.path)
+        except FileExistsError:
+            pass
+        os.remove(taken)
+        return False
+
+    def inspect(self, path):
+        """
+        Returns: tuple of the owner token of the lock file at path and its
+            age in seconds on the file server's clock, (None, None) if there
+            is no lock
+        """
+        probe = "{}.{}.probe".format(self.path, self.token.replace(":", "_"))
+        try:
+            with open(path) as f:
+                owner = f.read()
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None, None
+        with open(probe, "w"):
+            pass
+        try:
+            return owner, os.path.getmtime(probe) - mtime
+        finally:
+            os.remove(probe)
+
+    def owned(self):
+        """
+        Returns: bool; True if the lock file holds this process's token
+        """
+        try:
+            with open(self.path) as f:
+                return f.read() == self.token
+        except FileNotFoundError:
+            return False
+
+    def beat(self):
+        while not self.stop.wait(self.heartbeat):
+            if not self.owned():
+                print("Warning: lock \"{}\" was taken over".format(self.path))
+                return
+            os.utime(self.path)
+
+    def release(self):
+        """
+        Stops the heartbeat and removes the lock if it is still this
+        process's
+        """
+        self.stop.set()
+        if self.thread != None:
+            self.thread.join()
+        if self.owned():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def load_manifest(filepath):
+    """
+    Reads a manifest of the sensors to characterise. The manifest is a json
+    object with a list of "sensors", each with a "name", "dark_dir" and
+    "ptc_dir" and optionally an "out_dir" and any other argument of
+    pipeline.characterise. Arguments shared by every sensor can be given in
+    "defaults", and "out_root" is the directory the output directories of
+    sensors without an "out_dir" are made in.
+
+    Returns: list of dicts of the arguments of pipeline.characterise for each
+        sensor
+    """
+    with open(filepath) as f:
+        manifest = json.load(f)
+    root = os.path.dirname(os.path.abspath(filepath))
+    out_root = os.path.join(root, manifest.get("out_root", "Results"))
+    jobs = []
+    names = set()
+    for sensor in manifest["sensors"]:
+        job = dict(manifest.get("defaults", {}))
+        job.update(sensor)
+        name = job.pop("name")
+        if name in names:
+            raise ValueError("Sensor \"{}\" appears twice in \"{}\""\
+                .format(name, filepath))
+        names.add(name)
+        for key in ("dark_dir", "ptc_dir"):
+            job[key] = os.path.join(root, job[key])
+        job["out_dir"] = os.path.join(out_root, job.get("out_dir", name))
+        jobs.append((name, job))
+    return jobs
+
+
+def run_job(name, job, stale_after=STALE_AFTER):
+    """
+    Characterises one sensor if it is not done and no other process is
+    working on it. Executed by the worker processes of run_manifest.
+
+    Returns: str; "done", "skipped" (finished before or claimed elsewhere)
+        or "failed"
+    """
+    if os.path.isfile(os.path.join(job["out_dir"], DONE_NAME)):
+        return "skipped"
+    lock = JobLock(job["out_dir"], stale_after=stale_after)
+    if not lock.acquire():
+        print("Sensor \"{}\" is being characterised elsewhere".format(name))
+        return "skipped"
+    try:
+        # Another process may have finished it between the check and the lock
+        if os.path.isfile(os.path.join(job["out_dir"], DONE_NAME)):
+            return "skipped"
+        print("Characterising sensor \"{}\"".format(name))
+        maps = pipeline.characterise(**job)
+        return "failed" if maps == None else "done"
+    finally:
+        lock.release()
+
+
+def run_manifest(filepath, jobs=1, shard=None, stale_after=STALE_AFTER):
+    """
+    Characterises every sensor of a manifest with a pool of jobs worker
+    processes. Finished sensors are skipped and unfinished ones resume from
+    their cached stages and tile checkpoints, so an interrupted batch is
+    continued by running it again. Several machines sharing the filesystem
+    can run the same manifest at once, each sensor is claimed with a
+    JobLock so it is only characterised once.
+
+    Args:
+        filepath: str, path to the manifest, see load_manifest
+
+        jobs: int, number of sensors characterised at once
+
+        shard: tuple, (index, count) to only take every count-th sensor
+            starting at index, None to take any unclaimed sensor
+
+        stale_after: float, seconds after which the lock of a job that
+            stopped refreshing it is broken
+
+    Returns: dict of the status of each sensor
+    """
+    sensors = load_manifest(filepath)
+    if shard != None:
+        index, count = shard
+        sensors = sensors[index::count]
+    status = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {name: pool.submit(run_job, name, job, stale_after) \
+            for name, job in sensors}
+        for name, future in futures.items():
+            try:
+                status[name] = future.result()
+            except Exception as error:
+                print("Error: sensor \"{}\" failed with \"{}\"".format(name, \
+                    error))
+                status[name] = "failed"
+    for state in ("done", "skipped", "failed"):
+        print("{} sensors {}".format(list(status.values()).count(state), \
+            state))
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Characterises the sensors "\
+        "of a manifest, see batch.load_manifest")
+    parser.add_argument("manifest", help="path to the manifest json")
+    parser.add_argument("--jobs", type=int, default=1, \
+        help="number of sensors characterised at once")
+    parser.add_argument("--shard", default=None, \
+        help="INDEX/COUNT, only take every COUNT-th sensor from INDEX")
+    parser.add_argument("--stale-after", type=float, default=STALE_AFTER, \
+        help="seconds after which an unrefreshed lock is broken")
+    args = parser.parse_args()
+    shard = None
+    if args.shard != None:
+        shard = tuple(int(part) for part in args.shard.split("/"))
+    status = run_manifest(args.manifest, jobs=args.jobs, shard=shard, \
+        stale_after=args.stale_after)
+    if "failed" in status.values():
+        sys.exit(1)
@@ -4,36 +4,37 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy.stats as stats
 
+import moment_tools as mt
+import product_cache as pc
+import shared_store as ss
+import smooth_tools as st
+import tile_tools as tt
 
-def graph_mean(arr, smooth=None, resolution=(520, 520)):
+
+def graph_mean(arr, smooth=None, resolution=(520, 520), arr_avg=None):
     """Graphs the average of the inner dimension of a 2d np.ndarra
     
     Args:
         arr: np.ndarra 2d array to be graphed. 
 
+        arr_avg: np.ndarray, precomputed average of each frame, e.g.
+            run.frame_avg from the run's statistics sidecar. If given arr is
+            not read
+
     Returns:
         array of means
     """
-    pixels = resolution[0]*resolution[1]
-    arr = arr.reshape([-1, pixels])
-    arr_avg = arr.mean(axis=1)
-    arr_avg.reshape(-1)
+    if arr_avg is None:
+        pixels = resolution[0]*resolution[1]
+        arr = arr.reshape([-1, pixels])
+        arr_avg = arr.mean(axis=1)
+    arr_avg = np.array(arr_avg, dtype=float).reshape(-1)
     n_frames = len(arr_avg)
 
     # Sort out smoothing
     if smooth != None and isinstance(smooth, int):
         print("Smoothing over {} frames".format(smooth))
-        for i in range(n_frames):
-            frame_avg = 0
-            for j in range(2*smooth + 1):
-                k = i + j - smooth
-                if k < 0:
-                    k = 0
-                elif k > n_frames - 1:
-                    k = n_frames - 1
-                frame_avg += arr_avg[k]
-            frame_avg /= 2*smooth + 1
-            arr_avg[i] = frame_avg
+        arr_avg = st.moving_average(arr_avg, smooth)
 
     arr_im_num = np.linspace(1, n_frames, n_frames)
     fig_avg = plt.figure(num="avg", figsize=[8, 6])
@@ -68,16 +69,29 @@ def show_frame(frame_arr):
     plt.show()
 
 
-def get_noise(arr):
+def get_noise(arr, moments=None, chunk=mt.DEFAULT_CHUNK, noise=None):
     """
     Calculates the noise of one std deviation for each pixel in the sensor
     
     Args:
         arr: np.ndarray, array of pixels over all frames
 
+        moments: Moments class instance, precomputed moments of arr. If None
+            they are calculated in a single chunked pass over arr
+
+        chunk: int, number of frames read at a time
+
+        noise: np.ndarray, precomputed noise of arr, e.g. from
+            Settings.run_dark, arr is then not read
+
     returns: An array of noise values with the dimensions of the sensor
     """
-    noise_arr = arr.std(axis=0)
+    if noise is not None:
+        noise_arr = noise
+    else:
+        if moments == None:
+            moments = mt.get_moments(arr, chunk=chunk)
+        noise_arr = moments.std()
     # Choose whether to save
     print("Please enter a filename to save noise")
     name =  input("Press <enter> to skip\n")
@@ -89,16 +103,29 @@ def get_noise(arr):
     return noise_arr
 
 
-def get_offset(arr):
+def get_offset(arr, moments=None, chunk=mt.DEFAULT_CHUNK, offset=None):
     """
     Calculates the pedestal for each pixel in the sensor
 
     Args:
         arr: np.ndarray, array of pixels over all frames
 
+        moments: Moments class instance, precomputed moments of arr. If None
+            they are calculated in a single chunked pass over arr
+
+        chunk: int, number of frames read at a time
+
+        offset: np.ndarray, precomputed pedestal of arr, e.g. from
+            Settings.run_dark, arr is then not read
+
     returns: An array of pedestal values with the dimensions of the sensor
     """
-    ped_arr = arr.mean(axis=0)
+    if offset is not None:
+        ped_arr = offset
+    else:
+        if moments == None:
+            moments = mt.get_moments(arr, chunk=chunk)
+        ped_arr = moments.mean
     print("Please enter a filename to save offset")
     name =  input("Press <enter> to skip\n")
     if name != "":
@@ -130,51 +157,80 @@ def test_fit(xvals, yvals, mean, std, func="gauss"):
     # Check input
     model = {"gauss": (stats.norm.pdf, 2)}
     if func in model.keys():
-        theoretical = model(func)[0]
-        df = model(func)[1]
+        theoretical = model[func][0]
+        df = model[func][1]
     else: raise KeyError("\"{}\" is not a valid function".format(func))
-    try:
-        len(xvals) == len(yvals)
-    except:
+    if len(xvals) != len(yvals):
         raise ValueError("The shape of xvals does not equal the shape of yvals")
-    chi2, p_val = stats.chisquare(yvals, theoretical(xvals), df, axis=0)
+    expected = theoretical(xvals, mean, std)
+    expected *= np.sum(yvals) / np.sum(expected)
+    chi2, p_val = stats.chisquare(yvals, expected, df, axis=0)
     return chi2, p_val
 
 
-def check_pix(run, opb=1, func="gauss"):
+def check_tile(data, offset, err_dark, opb, func):
     """
+    Kernel for tile_tools.run_tiles, runs test_fit on each pixel in a tile
+
     Args:
-        run: Run class instance;
+        data: array-like; [n_frames, rows, columns] tile of frames
 
-        opb: int; output values per bin, number of unique values per bin
+        offset: array-like; tile of the offset of each pixel
+
+        err_dark: array-like; tile of the dark noise of each pixel
+
+        opb: int; output values per bin
 
         func: str; function used in test_fit
-    """
-    # determine the number useful frames
-    u_frames = run.n_frames - run.start_frame
 
-    # Check each individual pixel
-    for i in range(run.resolution[0]):
-        for j in range(run.resolution[1]):
+    Returns: [2, rows, columns] array of chi2 values and p values
+    """
+    result = np.zeros([2, *data.shape[1:]], dtype=float)
+    for i in range(data.shape[1]):
+        for j in range(data.shape[2]):
+            pixel = np.asarray(data[:, i, j])
             # Create bin sequence
-            bin_edge = np.arange(np.min(run.frame_arr[:, i, j]) - 0.5, \
-                np.max(run.frame_arr[:, i, j]) + 0.5, opb, dtype=float)
+            bin_edge = np.arange(np.min(pixel) - 0.5, \
+                np.max(pixel) + 0.5 + opb, opb, dtype=float)
             # Determine each bin edge
-            bin_prob = np.histogram(run.frame_arr[:, i, j], \
-                bins=bin_edge, density=True)[0]
+            bin_prob = np.histogram(pixel, bins=bin_edge, density=True)[0]
             # Determine each bin_mid, move up to middle and remove final point
-            bin_mid = (bin_edge[:-1] + 0.5).astype(int)
-            chi2, p_val = test_fit(bin_mid, bin_prob, run.offset, run.err_dark, func=func)
-            del bin_edge
-            # Check plot
-            plt.scatter(bin_mid, bin_prob)
-            plt.show()
-            
-    # # Check all pixels
-    # normal_frame_arr = np.zeros(run.frame_arr.shape, dtype=float)
-    # for i in range(run.start_frame, run.n_frames, 1):
-    #     normal_frame_arr[i] = (run.frame_arr[i] - run.offset) / run.err_dark
-    # n_bins = int(u_frames * run.resolution[0] / hpb)
-    # normal_frame_arr = normal_frame_arr.reshape(-1)
-    # plt.hist(normal_frame_arr, bins=n_bins, density=True)
-    # plt.show()
+            bin_mid = bin_edge[:-1] + opb/2
+            result[:, i, j] = test_fit(bin_mid, bin_prob, offset[i, j], \
+                err_dark[i, j], func=func)
+    return result
+
+
+def check_pix(run, opb=1, func="gauss", tile=tt.DEFAULT_TILE, workers=1, \
+    checkpoint=None):
+    """
+    Tests the distribution of each pixel in run against func. The sensor is
+    split into tiles which are tested in parallel with tile_tools.run_tiles.
+
+    Args:
+        run: Run or shared_store.SharedRun class instance; run with offset
+            and err_dark set, the frames of a SharedRun are attached by the
+            workers rather than copied
+
+        opb: int; output values per bin, number of unique values per bin
+
+        func: str; function used in test_fit
+
+        tile: array-like; (rows, columns) of each tile
+
+        workers: int; number of worker processes, None for one per cpu
+
+        checkpoint: str; directory where finished tiles are kept until every
+            pixel is tested, an interrupted test is resumed from them
+
+    Returns: [2, *resolution] array of chi2 values (dim 0) and p values (dim 1)
+    """
+    if run.offset is None or run.err_dark is None:
+        print("Error: run offset and dark noise must be set, aborting!")
+        return None
+    if checkpoint != None:
+        checkpoint = os.path.join(checkpoint, pc.product_key("check_pix", \
+            [run, run.offset, run.err_dark], {"opb": opb, "func": func})[0])
+    return tt.run_tiles(check_tile, [ss.run_frames(run), \
+        run.offset, run.err_dark], run.resolution, out_shape=(2,), \
+        args=(opb, func), tile=tile, workers=workers, checkpoint=checkpoint)
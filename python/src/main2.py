@@ -7,6 +7,8 @@ from time import sleep
 import run_path_tools as rpt
 import ptc_tools as ptc
 import image_analysis_tools as iat
+import moment_tools as mt
+import pixel_store as ps
 from settings import Settings
 from pearson_tools import Pearsontest 
 
@@ -57,6 +59,7 @@ if __name__=="__main__":
         print("Press <6> to analyse loaded PT curve")
         print("press <7> to analyse loaded chi2 test")
         print("Press <8> to update settings")
+        print("Press <9> to add a loaded run to a saved PT curve")
         print(QTE)
         func_choice = input()
         print("\n")
@@ -65,6 +68,8 @@ if __name__=="__main__":
             print("Please enter one of the following:")
             print("The path to a single dataset run")
             print("The path to a run directory containing multiple datasets")
+            print("The path to a pixel store (\"{}\") of a dataset run"\
+                .format(ps.STORE_EXT))
             print(ETS)
             run_path = input()
             if run_path == "":
@@ -74,13 +79,22 @@ if __name__=="__main__":
                 run_name = prog_data.new_run_name()
                 prog_data.saved_runs[run_name] = rpt.get_single_run(\
                     name=run_name, filepath=run_path,\
-                    start_frame=settings.start_frame)
+                    start_frame=settings.start_frame,\
+                    end_frame=settings.end_frame, step=settings.frame_step)
+                print("Run \"{}\" successfully created".format(run_name))
+            elif run_path.rstrip("/\\").endswith(ps.STORE_EXT) \
+                and os.path.isdir(run_path) == True:
+                print("Recieved path to a pixel store\n")
+                run_name = prog_data.new_run_name()
+                prog_data.saved_runs[run_name] = ps.get_store_run(\
+                    name=run_name, dirpath=run_path)
                 print("Run \"{}\" successfully created".format(run_name))
             elif os.path.isdir(run_path) == True:
                 print("Recived path to run directory\n")
                 run_name = prog_data.new_run_name()
                 prog_data.saved_runs[run_name] = rpt.get_multi_run(\
-                    dirpath=run_path, start_frame=settings.start_frame)
+                    dirpath=run_path, start_frame=settings.start_frame,\
+                    end_frame=settings.end_frame, step=settings.frame_step)
                 print("Run \"{}\" successfully created".format(run_name))
             else:
                 print("Error: the path \"{}\" was not recognised, aborting!\n"\
@@ -128,7 +142,7 @@ if __name__=="__main__":
             prog_data.saved_ptc[ptc_name] = ptc.get_ptc(\
                 prog_data.saved_runs[run_name], settings.offset,\
                 settings.dark_noise, settings.resolution,\
-                sort=sorting)
+                sort=sorting, cache=settings.cache)
             ptc.save_ptc_object(prog_data.saved_ptc.get(ptc_name), settings.src_path)
 
         elif func_choice == "3":
@@ -171,7 +185,13 @@ if __name__=="__main__":
                     sleep(1)
                     continue
                 run_num = prog_data.get_run_num(run_name)
-                iat.get_offset(prog_data.saved_runs.get(run_name).frame_arr)
+                run = prog_data.saved_runs.get(run_name)
+                dark = settings.run_dark(run)
+                if dark is not None:
+                    iat.get_offset(None, offset=dark[0])
+                else:
+                    iat.get_offset(run.frame_arr, \
+                        moments=mt.stats_moments(rpt.get_run_stats(run)))
                 sleep(1)
                 continue
 
@@ -185,7 +205,13 @@ if __name__=="__main__":
                     run_num = prog_data.get_run_num(run_name)
                 else:
                     run_num = 1
-                iat.get_noise(prog_data.saved_runs(run_name).frame_arr)
+                run = prog_data.saved_runs[run_name]
+                dark = settings.run_dark(run)
+                if dark is not None:
+                    iat.get_noise(None, noise=dark[1])
+                else:
+                    iat.get_noise(run.frame_arr, \
+                        moments=mt.stats_moments(rpt.get_run_stats(run)))
                 sleep(1)
                 continue
 
@@ -213,7 +239,7 @@ if __name__=="__main__":
                 confidence = pearson.get_p_val()
                 ppb = pearson.get_ppb()
                 settings.chi2_vals = pearson.run_test(run.frame_arr,\
-                    settings.resolution, ppb)
+                    settings.resolution, ppb, cache=settings.cache, source=run)
                 chi2_path = settings.new_chi2_path()
                 success = pearson.save_chi2_arr(chi2_path)
                 print("Success: {}".format(success))
@@ -273,6 +299,23 @@ if __name__=="__main__":
             # Change settings
             # Pedestal and dark values
 
+        elif func_choice == "9":
+        # Add illumination levels to a saved PT curve
+            if settings.check_offset() == False:
+                print("Error: no offset loaded,", end=" ")
+                print("please update settings first, aborting!")
+                sleep(1)
+                continue
+            run_name = prog_data.get_run_name()
+            if run_name == None:
+                sleep(1)
+                continue
+            run_series = prog_data.saved_runs[run_name]
+            if isinstance(run_series, rpt.Run):
+                run_series = [run_series]
+            ptc.update_ptc_object(run_series, settings.offset, \
+                settings.src_path)
+
         elif func_choice == "q":
             exit()
         
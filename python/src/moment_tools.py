@@ -0,0 +1,178 @@
+import numpy as np
+
+import run_path_tools as rpt
+import stats_cache as sc
+
+DEFAULT_CHUNK = 64
+
+
+class Moments():
+    """
+    Running per-pixel moments of a stack of frames. Frames are added in
+    chunks with update and partial moments from other files or workers are
+    combined with merge (Chan et al. parallel algorithm), so the full stack
+    never has to be held in memory.
+    """
+
+    def __init__(self, resolution):
+        """
+        Class attributes:
+            n: int, number of frames accumulated
+
+            mean: np.ndarray, pixel array of the running mean
+
+            m2: np.ndarray, pixel array of the running sum of squared
+                deviations from the mean
+
+            min: np.ndarray, pixel array of the smallest value seen
+
+            max: np.ndarray, pixel array of the largest value seen
+        """
+        self.resolution = tuple(resolution)
+        self.n = 0
+        self.mean = np.zeros(self.resolution, dtype=np.float64)
+        self.m2 = np.zeros(self.resolution, dtype=np.float64)
+        self.min = np.full(self.resolution, np.inf)
+        self.max = np.full(self.resolution, -np.inf)
+
+    def update(self, chunk):
+        """
+        Adds a chunk of frames to the moments
+
+        Args:
+            chunk: array-like, [n_frames, *resolution] array of frames
+        """
+        chunk = np.asarray(chunk)
+        if chunk.shape[0] == 0:
+            return
+        part = Moments(self.resolution)
+        part.n = chunk.shape[0]
+        part.mean = chunk.mean(axis=0, dtype=np.float64)
+        part.m2 = chunk.var(axis=0, dtype=np.float64)*part.n
+        part.min = chunk.min(axis=0)
+        part.max = chunk.max(axis=0)
+        self.merge(part)
+
+    def merge(self, other):
+        """
+        Combines the moments of other into self
+
+        Args:
+            other: Moments class instance, partial moments with the same
+                resolution
+        """
+        if other.resolution != self.resolution:
+            raise ValueError("Cannot merge moments with resolution {} into {}"\
+                .format(other.resolution, self.resolution))
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n = other.n
+            self.mean = np.array(other.mean, dtype=np.float64)
+            self.m2 = np.array(other.m2, dtype=np.float64)
+            self.min = np.array(other.min, dtype=np.float64)
+            self.max = np.array(other.max, dtype=np.float64)
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta*(other.n/n)
+        self.m2 += other.m2 + np.square(delta)*(self.n*other.n/n)
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self.n = n
+
+    def var(self, ddof=0):
+        """
+        Returns: pixel array of the variance with ddof delta degrees of
+            freedom
+        """
+        return self.m2 / (self.n - ddof)
+
+    def std(self, ddof=0):
+        """
+        Returns: pixel array of the standard deviation with ddof delta degrees
+            of freedom
+        """
+        return np.sqrt(self.var(ddof=ddof))
+
+
+def merge_moments(moments):
+    """
+    Merges a collection of partial moments, e.g. from different files or
+    workers
+
+    Args:
+        moments: array-like, collection of Moments class instances
+
+    Returns: Moments class instance of the combined frames
+    """
+    total = Moments(moments[0].resolution)
+    for part in moments:
+        total.merge(part)
+    return total
+
+
+def stats_moments(stats):
+    """
+    Converts the sums of a stats_cache.RunStats into moments
+
+    Args:
+        stats: RunStats class instance, e.g. from run_path_tools.get_run_stats
+
+    Returns: Moments class instance
+    """
+    moments = Moments(stats.sum.shape)
+    moments.n = stats.n_frames
+    moments.mean = stats.mean()
+    moments.m2 = stats.var()*stats.n_frames
+    moments.min = stats.min.astype(np.float64)
+    moments.max = stats.max.astype(np.float64)
+    return moments
+
+
+def get_moments(arr, chunk=DEFAULT_CHUNK):
+    """
+    Calculates the per-pixel moments of arr in one pass, reading chunk frames
+    at a time. arr can be a memory mapped run so that only one chunk is in
+    memory at once. Raw uint16 frames are reduced with the exact integer
+    sums of stats_cache.compute_run_stats, other data with the float
+    updates of Moments.
+
+    Args:
+        arr: array-like, [n_frames, *resolution] array of frames
+
+        chunk: int, number of frames to read at a time
+
+    Returns: Moments class instance
+    """
+    if np.dtype(arr.dtype) in (np.uint8, np.uint16):
+        return stats_moments(sc.compute_run_stats(arr, (0, None, 1), \
+            chunk=chunk))
+    moments = Moments(arr.shape[1:])
+    for i in range(0, arr.shape[0], chunk):
+        moments.update(arr[i:i + chunk])
+    return moments
+
+
+def file_moments(filepath, resolution, start_frame=0, end_frame=None, \
+    chunk=DEFAULT_CHUNK):
+    """
+    Calculates the per-pixel moments of the frames in [start_frame,
+    end_frame) of the raw file at filepath without loading the whole file
+
+    Args:
+        filepath: str, path to the raw run
+
+        resolution: array-like, resolution of the sensor
+
+        start_frame: int, first frame used
+
+        end_frame: int, frame to stop at (exclusive), None for all frames
+
+        chunk: int, number of frames to read at a time
+
+    Returns: Moments class instance
+    """
+    im, _ = rpt.map_file(filepath, resolution, start_frame=start_frame, \
+        end_frame=end_frame)
+    return get_moments(im, chunk=chunk)
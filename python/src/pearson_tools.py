@@ -1,8 +1,15 @@
 import os
 import numpy as np
-from scipy.stats import chisquare
+from scipy import special, stats
+
+import product_cache as pc
+import stats_cache as sc
+import tile_tools as tt
 
 ETS = "Pess <enter> to skip"
+DEFAULT_WIDTH = 64
+MIN_EXPECTED = 5
+NORMALITY_TESTS = ("ks", "ad")
 
 class Pearsontest():
     """
@@ -87,54 +94,265 @@ class Pearsontest():
             g_val /= norm
         return g_val
 
-    def run_test(self, data, resolution, ppb, model="gauss"):
+    def run_test(self, data, resolution, ppb, model="gauss", \
+        tile=tt.DEFAULT_TILE, workers=1, cache=None, source=None, \
+        checkpoint=None):
         """
-        Runs Pearson's chi-square test on data against a model distribution
+        Runs Pearson's chi-square test on data against a model distribution.
+        The test is evaluated for every pixel of a tile at once, see
+        test_block, and the tiles are spread over worker processes with
+        tile_tools.run_tiles so only the frames of the tiles being tested are
+        held in memory.
         
         Args:
-            data: array_like; data to run test on
-
-            axis: int; axis to evaluate test over if data is a multidimensional
-                array
+            data: array_like; [n_frames, *resolution] data to run test on, can
+                be a memory mapped run or a shared_store.SharedArray that the
+                workers attach to without copying
             
             ppb: int; unique points per bin i.e. number of unique values in
                 each bin.
             
             model: str; model function to test data against. Models are:
                 gauss - gaussian function
+
+            tile: array-like; (rows, columns) of the sensor tested at a time
+
+            workers: int; number of worker processes, None for one per cpu
+
+            cache: ProductCache; if given together with source, chi2 values
+                already calculated for the same run and parameters are reused
+
+            source: Run or str; run (or path to the run) that data was read
+                from, identifies data in the cache
+
+            checkpoint: str; directory where finished tiles are kept until
+                the test is complete, an interrupted test is resumed from
+                them. Requires source
         
-        Returns: p value for Pearson's chi-sqaure test. If data is a
-            multidimensional array then an array of p values are returned.
-        """
-        data = np.asarray(data, dtype=np.float64)
-        loc = data.mean(axis=0)
-        spread = data.std(axis=0)
-        chi2_arr = np.zeros([2, *resolution], dtype=np.float64)
-        for i in range(resolution[0]):
-            for j in range(resolution[1]):
-                # Create bin array with bins integer bins between max an min
-                bin_edge = np.arange(np.min(data[:, i, j]) - 0.5, \
-                    np.max(data[:, i, j]) + 0.5, step=ppb, dtype=float)
-                # Determine bin probabilities
-                bin_prob = np.histogram(data[:, i, j], \
-                    bins=bin_edge, density=True)[0]
-                # Determine empty bins
-                non_empty = bin_prob.nonzero()
-                # Remove empty bins
-                bin_prob = bin_prob[non_empty]
-                bin_mid = (bin_edge[non_empty] + 0.5).astype(int)
-                df = len(bin_mid)-2
-
-                # NOTE: there is an issue with the gaussian function, it does
-                # not calc the correct value! Try graphing them solution, must
-                # calc mean and spread for specific dataset!
-                expected_prob = self.gaussian(bin_mid, loc[i, j], spread[i, j],\
-                    sum=bin_prob.sum())
-                chi2_arr[0, i, j], chi2_arr[1, i, j] = chisquare(bin_prob,\
-                    expected_prob, ddof=df)
-                self.chi2_arr = chi2_arr
+        Returns: [2, *resolution] array of the chi2 values (dim 0) and p values
+            (dim 1) for each pixel
+        """
+        if model != "gauss":
+            raise KeyError("\"{}\" is not a valid model".format(model))
+        params = {"ppb": ppb, "model": model}
+        if source == None:
+            cache = None
+            checkpoint = None
+        if checkpoint != None:
+            # Tiles of different runs or parameters must not be mixed
+            checkpoint = os.path.join(checkpoint, \
+                pc.product_key("chi2", [source], params)[0])
+        compute = lambda: tt.run_tiles(chi2_tile, [data], resolution, \
+            out_shape=(2,), args=(ppb,), tile=tile, workers=workers, \
+            checkpoint=checkpoint)
+        chi2_arr = pc.cached_array(cache, "chi2", [source], params, compute)
+        self.chi2_arr = chi2_arr
         return chi2_arr
-    
+
+    def test_block(self, block, ppb):
+        """
+        Runs Pearson's chi-square test against a gaussian for each pixel in
+        block without looping over pixels. Each pixel's values are offset by
+        the pixel's own minimum and binned into its own run of bins in a
+        single flat histogram, so one bincount builds every histogram.
+
+        Args:
+            block: np.ndarray; [n_frames, n_pixels] data to run test on
+
+            ppb: int; unique points per bin
+
+        Returns: tuple of the chi2 values and p values of each pixel
+        """
+        loc = block.mean(axis=0, dtype=np.float64)
+        spread = block.std(axis=0, dtype=np.float64)
+        counts, low, n_bins, start = pixel_histograms(block, ppb)
+        return self.test_histograms(counts, low, n_bins, start, loc, spread, \
+            ppb)
+
+    def test_histograms(self, counts, low, n_bins, start, loc, spread, ppb, \
+        min_expected=MIN_EXPECTED):
+        """
+        Runs Pearson's chi-square test against a gaussian on the histograms
+        of many pixels laid out one after another in a flat array, see
+        pixel_histograms. The expected counts are the gaussian integrated over
+        each bin, empty bins included, and the sparse bins at both tails are
+        merged so each merged bin expects at least min_expected counts, see
+        merge_bins. The degrees of freedom are the number of merged bins
+        less 3.
+
+        Args:
+            counts: flat array of the bin counts of all pixels
+
+            low: array of the lowest value (first bin edge) of each pixel
+
+            n_bins: array of the number of bins of each pixel
+
+            start: array of the index in counts where each pixel's bins
+                start, with the total number of bins appended
+
+            loc: array of the mean of each pixel
+
+            spread: array of the std. dev. of each pixel
+
+            ppb: int; unique points per bin
+
+            min_expected: float; smallest expected count of a merged tail
+                bin
+
+        Returns: tuple of the chi2 values and p values of each pixel
+        """
+        n_pix = len(n_bins)
+        # Pixel and bin number of every entry in the flat histogram
+        pix = np.repeat(np.arange(n_pix), n_bins)
+        bin_num = np.arange(counts.size) - np.repeat(start[:-1], n_bins)
+        expected = self.expected_counts(low, n_bins, pix, bin_num, loc, \
+            spread, ppb, np.bincount(pix, weights=counts, minlength=n_pix))
+        group, n_groups = merge_bins(expected, pix, start, min_expected)
+        observed = np.bincount(group, weights=counts, minlength=n_groups)
+        expected = np.bincount(group, weights=expected, minlength=n_groups)
+        group_pix = np.zeros(n_groups, dtype=np.intp)
+        group_pix[group] = pix
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = np.square(observed - expected)/expected
+        chi2 = np.bincount(group_pix, weights=terms, minlength=n_pix)
+        # Degrees of freedom, the mean and std. dev. are fitted
+        dof = np.bincount(group_pix, minlength=n_pix) - 3
+        p_val = np.full(n_pix, np.nan)
+        valid = (dof > 0) & np.isfinite(chi2)
+        p_val[valid] = stats.chi2.sf(chi2[valid], dof[valid])
+        chi2[~np.isfinite(chi2)] = np.nan
+        return chi2, p_val
+
+    def expected_counts(self, low, n_bins, pix, bin_num, loc, spread, ppb, \
+        total):
+        """
+        Expected counts of every bin of a flat histogram for a gaussian with
+        each pixel's mean and std. dev., integrated over the bin as the
+        difference of the cdf at its edges. A bin of integer values v to
+        v + ppb - 1 spans v - 0.5 to v + ppb - 0.5, and the first and last bin
+        of each pixel are open ended so a pixel's expected counts add up to
+        its total count.
+
+        Args:
+            low: array of the lowest value of each pixel's first bin
+
+            n_bins: array of the number of bins of each pixel
+
+            pix: flat array of the pixel of every bin
+
+            bin_num: flat array of the number of every bin within its pixel
+
+            loc: array of the mean of each pixel
+
+            spread: array of the std. dev. of each pixel
+
+            ppb: int; unique points per bin
+
+            total: array of the number of values of each pixel
+
+        Returns: flat array of the expected counts
+        """
+        lower = low[pix] + bin_num*ppb - 0.5
+        upper = lower + ppb
+        lower[bin_num == 0] = -np.inf
+        upper[bin_num == n_bins[pix] - 1] = np.inf
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = 1/spread[pix]
+            prob = special.ndtr((upper - loc[pix])*scale) \
+                - special.ndtr((lower - loc[pix])*scale)
+        return prob*total[pix]
+
+    def run_stream(self, data, resolution, ppb, chunk=sc.CHUNK, \
+        width=DEFAULT_WIDTH, center=None, cache=None, source=None):
+        """
+        Runs Pearson's chi-square test like run_test, but by streaming data
+        chunk frames at a time through a HistogramAccumulator so memory use
+        does not depend on the number of frames
+
+        Args:
+            data: array_like; [n_frames, *resolution] data to run test on,
+                e.g. a memory mapped run
+
+            ppb: int; unique points per bin
+
+            chunk: int; number of frames read at a time
+
+            width: int; range of values around each pixel's center that is
+                histogrammed, see HistogramAccumulator
+
+            center: array-like; pixel array of the value each pixel's
+                histogram is centred on, e.g. the offset. If None the median
+                of the first chunk is used
+
+            cache: ProductCache; if given together with source, chi2 values
+                already calculated for the same run and parameters are reused
+
+            source: Run or str; run (or path to the run) that data was read
+                from, identifies data in the cache
+
+        Returns: [2, *resolution] array of the chi2 values (dim 0) and p values
+            (dim 1) for each pixel
+        """
+        def compute():
+            accumulator = HistogramAccumulator(resolution, ppb=ppb, \
+                width=width, center=center)
+            for i in range(0, len(data), chunk):
+                accumulator.update(data[i:i + chunk])
+            return accumulator.result()
+        if source == None:
+            cache = None
+        params = {"ppb": ppb, "width": width, "stream": True}
+        if center is not None:
+            params["center"] = pc.identify(np.asarray(center))
+        chi2_arr = pc.cached_array(cache, "chi2", [source], params, compute)
+        self.chi2_arr = chi2_arr
+        return chi2_arr
+
+    def run_normality(self, data, resolution, test="ad", tile=(8, 520), \
+        workers=1, cache=None, source=None, checkpoint=None):
+        """
+        Runs a Kolmogorov-Smirnov or Anderson-Darling test of every pixel
+        against a gaussian with the pixel's own mean and std. dev., see
+        normality_block. Unlike the chi2 test no binning is involved. The
+        tiles are spread over worker processes like in run_test.
+
+        Args:
+            data: array_like; [n_frames, *resolution] data to run test on, can
+                be a memory mapped run or a shared_store.SharedArray
+
+            test: str; "ks" for Kolmogorov-Smirnov or "ad" for
+                Anderson-Darling
+
+            tile: array-like; (rows, columns) of the sensor tested at a time
+
+            workers: int; number of worker processes, None for one per cpu
+
+            cache: ProductCache; if given together with source, results
+                already calculated for the same run and test are reused
+
+            source: Run or str; run (or path to the run) that data was read
+                from, identifies data in the cache
+
+            checkpoint: str; directory where finished tiles are kept until
+                the test is complete. Requires source
+
+        Returns: [2, *resolution] array of the test statistic (dim 0) and p
+            values (dim 1) for each pixel, laid out like the chi2 array
+        """
+        if test not in NORMALITY_TESTS:
+            raise KeyError("\"{}\" is not a valid test".format(test))
+        params = {"test": test}
+        if source == None:
+            cache = None
+            checkpoint = None
+        if checkpoint != None:
+            checkpoint = os.path.join(checkpoint, \
+                pc.product_key("normality", [source], params)[0])
+        compute = lambda: tt.run_tiles(normality_tile, [data], resolution, \
+            out_shape=(2,), args=(test,), tile=tile, workers=workers, \
+            checkpoint=checkpoint)
+        return pc.cached_array(cache, "normality", [source], params, compute)
+
     def save_chi2_arr(self, filepath):
         """
         Saves the loaded self.chi2_arr
@@ -175,15 +393,311 @@ class Pearsontest():
         print("Total number of pixels cut: {}".format(bad_pix_abs))
         print("Relative number of pixels cut: {}".format(bad_pix_rel))
         return passed_pixels
-        
 
 
-        
+def chi2_tile(data, ppb):
+    """
+    Kernel for tile_tools.run_tiles, runs Pearsontest.test_block over a tile
 
+    Args:
+        data: array_like; [n_frames, rows, columns] tile of data
 
+        ppb: int; unique points per bin
 
-        
+    Returns: [2, rows, columns] array of chi2 values and p values
+    """
+    block = np.asarray(data)
+    chi2, p_val = Pearsontest().test_block(\
+        block.reshape(block.shape[0], -1), ppb)
+    return np.stack([chi2, p_val]).reshape(2, *block.shape[1:])
+
+
+def pixel_histograms(block, ppb):
+    """
+    Builds a histogram for every pixel in block with one bincount. Each
+    pixel's values are offset by the pixel's minimum and its bins are laid
+    out one after another in a single flat array.
+
+    Args:
+        block: np.ndarray; [n_frames, n_pixels] data to histogram
+
+        ppb: int; unique points per bin
+
+    Returns: tuple of
+        counts: flat array of the bin counts of all pixels
+        low: array of the lowest value (first bin edge) of each pixel
+        n_bins: array of the number of bins of each pixel
+        start: array of the index in counts where each pixel's bins start,
+            with the total number of bins appended
+    """
+    low = block.min(axis=0)
+    high = block.max(axis=0)
+    n_bins = ((high - low) // ppb).astype(np.intp) + 1
+    start = np.zeros(block.shape[1] + 1, dtype=np.intp)
+    np.cumsum(n_bins, out=start[1:])
+    index = ((block - low) // ppb).astype(np.intp)
+    index += start[:-1]
+    counts = np.bincount(index.reshape(-1), minlength=start[-1])
+    return counts, low, n_bins, start
+
+
+def merge_bins(expected, pix, start, min_expected=MIN_EXPECTED):
+    """
+    Merges the sparse tail bins of every pixel of a flat histogram without
+    looping over pixels. The front tail runs up to the first bin that expects
+    at least min_expected counts itself and has at least min_expected in
+    front of it, and is joined into one bin, as is the back tail behind the
+    last such bin counted from the back. Every merged tail therefore expects
+    at least min_expected counts, and so does every bin between them when the
+    expected counts rise to a single peak, as those of a gaussian do. If the
+    tails meet the whole pixel becomes one bin and its test is undefined.
+
+    Args:
+        expected: flat array of the expected counts of every bin
+
+        pix: flat array of the pixel of every bin
+
+        start: array of the index where each pixel's bins start, with the
+            total number of bins appended
+
+        min_expected: float, smallest expected count of a merged tail bin
+
+    Returns: tuple of the flat array of the merged bin of every bin,
+        numbered across all pixels, and the number of merged bins
+    """
+    n_pix = len(start) - 1
+    n_bins = len(expected)
+    expected = np.nan_to_num(expected)
+    cumsum = np.cumsum(expected)
+    # Expected counts of the pixel in front of and behind each bin
+    before = cumsum - expected
+    before -= np.concatenate([[0], cumsum[start[1:-1] - 1]])[pix]
+    behind = np.bincount(pix, weights=expected, minlength=n_pix)[pix] \
+        - before - expected
+    dense = expected >= min_expected
+    index = np.arange(n_bins)
+    # First and last bin of each pixel that can end a tail
+    first = np.minimum.reduceat(np.where(dense & (before >= min_expected), \
+        index, n_bins), start[:-1])
+    last = np.maximum.reduceat(np.where(dense & (behind >= min_expected), \
+        index, -1), start[:-1])
+    left = index < first[pix]
+    right = index > last[pix]
+    # Every bin is labelled with the first bin of the merged bin it joins
+    label = index.copy()
+    label[right] = (start[1:] - 1)[pix[right]]
+    label[left] = start[pix[left]]
+    whole = np.bincount(pix, weights=left & right, minlength=n_pix) > 0
+    label[whole[pix]] = start[pix[whole[pix]]]
+    new = np.ones(n_bins, dtype=bool)
+    new[1:] = label[1:] != label[:-1]
+    group = np.cumsum(new) - 1
+    return group, int(new.sum())
+
+
+def normality_tile(data, test):
+    """
+    Kernel for tile_tools.run_tiles, runs normality_block over a tile
+
+    Args:
+        data: array_like; [n_frames, rows, columns] tile of data
+
+        test: str; "ks" or "ad"
+
+    Returns: [2, rows, columns] array of the statistics and p values
+    """
+    block = np.asarray(data)
+    stat, p_val = normality_block(block.reshape(block.shape[0], -1), test)
+    return np.stack([stat, p_val]).reshape(2, *block.shape[1:])
+
+
+def normality_block(block, test):
+    """
+    Tests every pixel of block against a gaussian with the pixel's mean and
+    std. dev. from a single sort along the frame axis. The sorted values are
+    mapped through the gaussian cdf and the statistic is computed from the
+    resulting probabilities.
+
+    Integer data is treated as a gaussian rounded to whole numbers: the
+    variance is corrected for the rounding (Sheppard's correction) and the
+    n copies of a repeated value are spread evenly over the probability of
+    its unit wide bin, so ties do not fail the test. This makes the p values
+    of integer data somewhat conservative.
+
+    Args:
+        block: np.ndarray; [n_frames, n_pixels] data to run test on
+
+        test: str; "ks" or "ad"
 
-        # Check for dimensions of array.
-        # calc array of pearsons cumulative test parameter
-        # compare test parameter with chi square test over correct axis
\ No newline at end of file
+    Returns: tuple of the statistic and p value of each pixel. For "ks" the
+        statistic is D and the p value is the Dallal-Wilkinson approximation
+        of the Lilliefors distribution, accurate below 0.1. For "ad" it is A²
+        and the p value follows D'Agostino and Stephens for a fitted mean and
+        std. dev.
+    """
+    data = np.sort(block, axis=0)
+    n = data.shape[0]
+    loc = data.mean(axis=0, dtype=np.float64)
+    var = data.var(axis=0, dtype=np.float64, ddof=1)
+    discrete = np.issubdtype(data.dtype, np.integer)
+    if discrete:
+        var -= 1/12
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = 1/np.sqrt(var)
+        if discrete:
+            rank = np.arange(n)[:, None]
+            # First and last position of each run of equal values
+            new = np.ones(data.shape, dtype=bool)
+            new[1:] = data[1:] != data[:-1]
+            first = np.maximum.accumulate(np.where(new, rank, 0), axis=0)
+            end = np.ones(data.shape, dtype=bool)
+            end[:-1] = new[1:]
+            last = np.minimum.accumulate(\
+                np.where(end, rank, n - 1)[::-1], axis=0)[::-1]
+            lower = special.ndtr((data - 0.5 - loc)*scale)
+            upper = special.ndtr((data + 0.5 - loc)*scale)
+            prob = lower + (rank - first + 0.5)/(last - first + 1) \
+                *(upper - lower)
+        else:
+            prob = special.ndtr((data - loc)*scale)
+    i = np.arange(1, n + 1)[:, None]
+    if test == "ks":
+        stat = np.maximum((i/n - prob).max(axis=0), \
+            (prob - (i - 1)/n).max(axis=0))
+        # Dallal-Wilkinson, beyond 100 frames the statistic is rescaled
+        d_val, n_eff = stat, n
+        if n > 100:
+            d_val, n_eff = stat*(n/100)**0.49, 100
+        p_val = np.exp(-7.01256*np.square(d_val)*(n_eff + 2.78019) \
+            + 2.99587*d_val*np.sqrt(n_eff + 2.78019) - 0.122119 \
+            + 0.974598/np.sqrt(n_eff) + 1.67997/n_eff)
+        p_val = np.minimum(p_val, 1)
+    else:
+        prob = np.clip(prob, 1e-300, 1)
+        with np.errstate(divide="ignore"):
+            stat = -n - np.sum((2*i - 1)*(np.log(prob) \
+                + np.log1p(-prob[::-1])), axis=0)/n
+        a_val = stat*(1 + 0.75/n + 2.25/n**2)
+        p_val = np.where(a_val >= 0.6, \
+            np.exp(1.2937 - 5.709*a_val + 0.0186*np.square(a_val)), \
+            np.where(a_val >= 0.34, \
+            np.exp(0.9177 - 4.279*a_val - 1.38*np.square(a_val)), \
+            np.where(a_val >= 0.2, \
+            1 - np.exp(-8.318 + 42.796*a_val - 59.938*np.square(a_val)), \
+            1 - np.exp(-13.436 + 101.14*a_val - 223.73*np.square(a_val)))))
+    # Pixels without spread cannot be tested
+    invalid = ~(var > 0)
+    stat[invalid] = np.nan
+    p_val[invalid] = np.nan
+    return stat, p_val
+
+
+class HistogramAccumulator():
+    """
+    Per-pixel histograms of a run built up a chunk of frames at a time. Each
+    pixel has a fixed table of bins over the narrow range of values around
+    its center (e.g. its offset), values outside the table are counted as
+    underflow or overflow. The exact integer sums of stats_cache give the
+    mean and std. dev. of each pixel, outliers included, so the test can be
+    evaluated at any time and updated as more frames arrive.
+    """
+
+    def __init__(self, resolution, ppb=1, width=DEFAULT_WIDTH, center=None, \
+        dtype=np.uint32):
+        """
+        Args:
+            resolution: array-like, resolution of the sensor
+
+            ppb: int, unique points per bin
+
+            width: int, number of values covered by each pixel's table,
+                rounded up to a whole number of bins
+
+            center: array-like, pixel array of the value each table is
+                centred on, None to use the median of the first chunk
+
+            dtype: data type of the bin counts, uint32 holds any run length
+
+        Class attributes:
+            counts: [n_pixels, n_bins] array of the bin counts
+
+            low: array of the lowest value of each pixel's first bin
+
+            under: array of the number of values below each pixel's table
+
+            over: array of the number of values above each pixel's table
+
+            stats: stats_cache.RunStats of all the frames added
+        """
+        self.resolution = tuple(resolution)
+        self.ppb = ppb
+        self.n_bins = -(-width // ppb)
+        n_pix = self.resolution[0]*self.resolution[1]
+        self.counts = np.zeros([n_pix, self.n_bins], dtype=dtype)
+        self.under = np.zeros(n_pix, dtype=np.int64)
+        self.over = np.zeros(n_pix, dtype=np.int64)
+        self.stats = sc.RunStats(self.resolution, (0, None, 1))
+        self.low = None
+        if center is not None:
+            self.set_center(center)
+
+    def set_center(self, center):
+        """
+        Places each pixel's table so that it is centred on center
+        """
+        center = np.rint(np.asarray(center, dtype=np.float64)).reshape(-1)
+        self.low = (center - self.n_bins*self.ppb//2).astype(np.int64)
+
+    def update(self, frames):
+        """
+        Adds a chunk of frames to the histograms
+
+        Args:
+            frames: array-like, [n_frames, *resolution] uint16 frames
+        """
+        frames = np.asarray(frames)
+        if len(frames) == 0:
+            return
+        if self.low is None:
+            self.set_center(np.median(frames, axis=0))
+        sc.accumulate(self.stats, frames)
+        flat = self.counts.reshape(-1)
+        base = np.arange(len(self.low))*self.n_bins
+        for frame in frames.reshape(len(frames), -1):
+            index = (frame - self.low) // self.ppb
+            below = index < 0
+            above = index >= self.n_bins
+            self.under += below
+            self.over += above
+            inside = ~(below | above)
+            # Each pixel appears once per frame so the indices are unique
+            flat[base[inside] + index[inside]] += 1
+
+    def merge(self, other):
+        """
+        Adds the histograms of other, made with the same centers and bins
+        """
+        self.counts += other.counts
+        self.under += other.under
+        self.over += other.over
+        self.stats.merge(other.stats)
+
+    def result(self):
+        """
+        Tests the accumulated histograms. Values below or above a pixel's
+        table are counted in its open ended first or last bin.
+
+        Returns: [2, *resolution] array of the chi2 values (dim 0) and p
+            values (dim 1) for each pixel
+        """
+        n_pix = len(self.low)
+        n_bins = np.full(n_pix, self.n_bins, dtype=np.intp)
+        start = np.arange(n_pix + 1, dtype=np.intp)*self.n_bins
+        loc = self.stats.mean().reshape(-1)
+        spread = np.sqrt(self.stats.var()).reshape(-1)
+        counts = self.counts.astype(np.int64)
+        counts[:, 0] += self.under
+        counts[:, -1] += self.over
+        chi2, p_val = Pearsontest().test_histograms(counts.reshape(-1), \
+            self.low, n_bins, start, loc, spread, self.ppb)
+        return np.stack([chi2, p_val]).reshape(2, *self.resolution)
@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+import moment_tools as mt
+import product_cache as pc
+import ptc_tools as ptc
+import run_path_tools as rpt
+from pearson_tools import Pearsontest
+
+RESOLUTION = (520, 520)
+# Flags of the bad pixel map, a pixel can have several
+BAD_OFFSET = 1
+BAD_NOISE = 2
+BAD_DEAD = 4
+BAD_CHI2 = 8
+BAD_GAIN = 16
+OUTLIER_SIGMA = 5
+MAPS = ("offset", "dark_noise", "chi2", "gain", "read_noise", "full_well", \
+    "dynamic_range", "fpn_quality", "bad_pixels")
+
+
+def run_stages(stages, workers=None):
+    """
+    Runs a dependency graph of stages, starting every stage as soon as the
+    stages it depends on have finished so that independent stages run
+    concurrently on a thread pool. Process pools started by the stages use
+    shared_store.pool_context, so no process is forked while other stages
+    run
+
+    Args:
+        stages: dict, maps the name of each stage to a tuple of the names of
+            the stages it depends on and a function that is called with their
+            results in that order
+
+        workers: int, number of stages run at once, None for the thread pool
+            default
+
+    Returns: dict of the result of each stage
+    """
+    results = {}
+    pending = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            for name in list(pending):
+                deps, func = pending[name]
+                if all(dep in results for dep in deps):
+                    del pending[name]
+                    print("Starting stage \"{}\"".format(name))
+                    future = pool.submit(func, *[results[dep] for dep in deps])
+                    running[future] = (name, time.perf_counter())
+            if len(running) == 0:
+                raise ValueError("Stages {} depend on missing stages"\
+                    .format(list(pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, begin = running.pop(future)
+                results[name] = future.result()
+                print("Finished stage \"{}\" in {:.1f} s".format(name, \
+                    time.perf_counter() - begin))
+    return results
+
+
+def dark_maps(filepaths, resolution, start_frame=0, end_frame=None, step=1, \
+    cache=None, chunk=mt.DEFAULT_CHUNK):
+    """
+    Calculates the offset and dark noise from dark runs, cached under the
+    same key as settings.Settings.get_dark
+
+    Returns: [2, *resolution] array of the offset (dim 0) and dark noise
+        (dim 1)
+    """
+    def compute():
+        moments = mt.merge_moments([mt.stats_moments(rpt.get_file_stats(\
+            filepath, resolution, start_frame=start_frame, \
+            end_frame=end_frame, step=step, chunk=chunk)) \
+            for filepath in filepaths])
+        return np.stack([moments.mean, moments.std()])
+    return pc.cached_array(cache, "dark", filepaths, \
+        {"start_frame": start_frame, "end_frame": end_frame, \
+        "frame_step": step}, compute)
+
+
+def outliers(arr, n_sigma=OUTLIER_SIGMA):
+    """
+    Returns: bool pixel array of the pixels more than n_sigma robust standard
+        deviations (from the median absolute deviation) from the median
+    """
+    median = np.nanmedian(arr)
+    sigma = 1.4826*np.nanmedian(np.abs(arr - median))
+    with np.errstate(invalid="ignore"):
+        return np.abs(arr - median) > n_sigma*sigma
+
+
+def bad_pixel_map(dark, chi2, gain, alpha=0.001, n_sigma=OUTLIER_SIGMA):
+    """
+    Flags the pixels that should not be used, see the BAD_* flags
+
+    Args:
+        dark: [2, *resolution] array of the offset and dark noise
+
+        chi2: [2, *resolution] array of the chi2 and p values of the dark run
+
+        gain: [3, *resolution] array of the gain, read noise and full well,
+            see ptc_tools.get_gain_maps
+
+        alpha: float, pixels whose dark values fit a gaussian with a p value
+            below alpha are flagged
+
+        n_sigma: float, offset and noise outlier threshold
+
+    Returns: uint8 pixel array of the flags of each pixel, 0 for good pixels
+    """
+    bad = np.zeros(dark.shape[1:], dtype=np.uint8)
+    bad[outliers(dark[0], n_sigma)] |= BAD_OFFSET
+    bad[outliers(dark[1], n_sigma)] |= BAD_NOISE
+    bad[dark[1] == 0] |= BAD_DEAD
+    with np.errstate(invalid="ignore"):
+        bad[~(chi2[1] >= alpha)] |= BAD_CHI2
+        bad[~(np.isfinite(gain[[0, 2]]).all(axis=0) & (gain[0] > 0))] \
+            |= BAD_GAIN
+    return bad
+
+
+def characterise(dark_dir, ptc_dir, out_dir, dark_id="", ptc_id="", \
+    resolution=RESOLUTION, start_frame=20, end_frame=None, step=1, ppb=1, \
+    alpha=0.001, smooth=3, sort=True, workers=None, cache_dir=None, \
+    checkpoint_dir=None):
+    """
+    Produces the full set of maps of one sensor without asking for input.
+    The stages form a dependency graph that is run with run_stages, e.g. the
+    chi2 test of the first dark run runs alongside the offset, PT curve and gain
+    stages. Every expensive stage is cached, so rerunning after an
+    interruption or with new parameters only repeats what changed.
+
+    Args:
+        dark_dir: str, directory of the dark runs
+
+        ptc_dir: str, directory of the PT curve (illumination level) runs
+
+        out_dir: str, directory the maps are saved to as .npy files together
+            with the PT curve and a summary.json
+
+        dark_id: str, identifier that filenames of the dark runs must contain
+
+        ptc_id: str, identifier that filenames of the PTC runs must contain
+
+        resolution: array-like, resolution of the sensor
+
+        start_frame: int, first useful frame of each run
+
+        end_frame: int, frame to stop at in each run (exclusive)
+
+        step: int, stride between the dark frames used
+
+        ppb: int, unique values per bin of the chi2 test, which is run on
+            the first dark run and recorded as "chi2_run" in summary.json
+
+        alpha: float, p value below which a pixel fails the chi2 test
+
+        smooth: int, smoothing used to find the full well peak
+
+        sort: bool, sort each pixel's PT curve against mean signal
+
+        workers: int, number of worker processes of the per-pixel stages,
+            None for one per cpu
+
+        cache_dir: str, directory of the product cache, None for
+            out_dir/Cache
+
+        checkpoint_dir: str, directory of the per-tile checkpoints of the
+            chi2 test, None for out_dir/Checkpoints
+
+    Returns: dict of the maps, or None if runs are missing
+    """
+    dark_files = rpt.find_run_files(dark_dir, dark_id)
+    ptc_files = rpt.find_run_files(ptc_dir, ptc_id)
+    if len(dark_files) == 0 or len(ptc_files) == 0:
+        print("Error: no dark runs in \"{}\" or no PTC runs in \"{}\", "\
+            "aborting!".format(dark_dir, ptc_dir))
+        return None
+    os.makedirs(out_dir, exist_ok=True)
+    if cache_dir == None:
+        cache_dir = os.path.join(out_dir, "Cache")
+    cache = pc.ProductCache(cache_dir)
+    if checkpoint_dir == None:
+        checkpoint_dir = os.path.join(out_dir, "Checkpoints")
+
+    def chi2_stage():
+        run = rpt.get_single_run(os.path.basename(dark_files[0]), \
+            dark_files[0], start_frame, end_frame, step)
+        return Pearsontest().run_test(run.frame_arr, resolution, ppb, \
+            workers=workers, cache=cache, source=run, \
+            checkpoint=checkpoint_dir)
+
+    def ptc_stage(dark):
+        pt_curve = ptc.get_ptc_dir(ptc_dir, dark[0], resolution, \
+            run_id=ptc_id, sort=sort, start_frame=start_frame, \
+            end_frame=end_frame, workers=1 if workers == None else workers, \
+            cache=cache)
+        ptc.write_ptc(pt_curve, os.path.join(out_dir, "ptc" + ptc.PTC_EXT))
+        return pt_curve
+
+    def gain_stage(pt_curve):
+        return np.stack(ptc.get_gain_maps(pt_curve, smooth=smooth, \
+            cache=cache))
+
+    def dynamic_stage(dark, gain):
+        # The dark noise rather than the fitted read noise, which is missing
+        # where the fit's intercept is negative
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return 20*np.log10(gain[2]/(dark[1]*gain[0]))
+
+    def fpn_stage(dark):
+        # Fixed pattern noise is the spread of the offset over the sensor
+        with np.errstate(divide="ignore"):
+            return np.std(dark[0])/dark[0]
+
+    stages = {
+        "dark": ((), lambda: dark_maps(dark_files, resolution, start_frame, \
+            end_frame, step, cache=cache)),
+        "chi2": ((), chi2_stage),
+        "ptc": (("dark",), ptc_stage),
+        "gain": (("ptc",), gain_stage),
+        "dynamic_range": (("dark", "gain"), dynamic_stage),
+        "fpn_quality": (("dark",), fpn_stage),
+        "bad_pixels": (("dark", "chi2", "gain"), \
+            lambda dark, chi2, gain: bad_pixel_map(dark, chi2, gain, alpha))}
+    begin = time.perf_counter()
+    results = run_stages(stages)
+    maps = {"offset": results["dark"][0], "dark_noise": results["dark"][1], \
+        "chi2": results["chi2"], "gain": results["gain"][0], \
+        "read_noise": results["gain"][1], "full_well": results["gain"][2], \
+        "dynamic_range": results["dynamic_range"], \
+        "fpn_quality": results["fpn_quality"], \
+        "bad_pixels": results["bad_pixels"]}
+    for name in MAPS:
+        np.save(os.path.join(out_dir, name + ".npy"), maps[name])
+    bad = maps["bad_pixels"]
+    summary = {"dark_runs": dark_files, "ptc_runs": ptc_files, \
+        "start_frame": start_frame, "end_frame": end_frame, "step": step, \
+        "ppb": ppb, "chi2_run": dark_files[0], "alpha": alpha, "smooth": smooth, "sort": sort, \
+        "bad_pixels": int(np.count_nonzero(bad)), \
+        "bad_flags": {flag: int(np.count_nonzero(bad & value)) for flag, value \
+        in (("offset", BAD_OFFSET), ("noise", BAD_NOISE), ("dead", BAD_DEAD), \
+        ("chi2", BAD_CHI2), ("gain", BAD_GAIN))}, \
+        "median_gain": float(np.nanmedian(maps["gain"][bad == 0])) \
+            if np.any(bad == 0) else None, \
+        "seconds": time.perf_counter() - begin}
+    with open(os.path.join(out_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=1)
+    print("Saved maps of \"{}\" to \"{}\", {} bad pixels".format(ptc_dir, \
+        out_dir, summary["bad_pixels"]))
+    return maps
+
+
+def get_parser():
+    """
+    Returns: argparse.ArgumentParser of the command line of characterise
+    """
+    parser = argparse.ArgumentParser(description="Produces the offset, "\
+        "noise, chi2, PT curve, gain, read noise, full well, dynamic range "\
+        "and bad pixel maps of a sensor without asking for input")
+    parser.add_argument("dark_dir", help="directory of the dark runs")
+    parser.add_argument("ptc_dir", help="directory of the PT curve runs")
+    parser.add_argument("out_dir", help="directory the maps are saved to")
+    parser.add_argument("--dark-id", default="", \
+        help="identifier in the dark run filenames")
+    parser.add_argument("--ptc-id", default="", \
+        help="identifier in the PTC run filenames")
+    parser.add_argument("--start-frame", type=int, default=20)
+    parser.add_argument("--end-frame", type=int, default=None)
+    parser.add_argument("--step", type=int, default=1)
+    parser.add_argument("--ppb", type=int, default=1, \
+        help="unique values per bin of the chi2 test")
+    parser.add_argument("--alpha", type=float, default=0.001, \
+        help="p value below which a pixel fails the chi2 test")
+    parser.add_argument("--smooth", type=int, default=3)
+    parser.add_argument("--no-sort", dest="sort", action="store_false")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--checkpoint-dir", default=None, \
+        help="directory of the chi2 tile checkpoints")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    maps = characterise(args.dark_dir, args.ptc_dir, args.out_dir, \
+        dark_id=args.dark_id, ptc_id=args.ptc_id, \
+        start_frame=args.start_frame, end_frame=args.end_frame, \
+        step=args.step, ppb=args.ppb, alpha=args.alpha, smooth=args.smooth, \
+        sort=args.sort, workers=args.workers, cache_dir=args.cache_dir, \
+        checkpoint_dir=args.checkpoint_dir)
+    if maps == None:
+        sys.exit(1)
@@ -0,0 +1,227 @@
+import os
+import json
+
+import numpy as np
+
+import run_path_tools as rpt
+import stats_cache as sc
+
+STORE_EXT = ".pix"
+STORE_VERSION = 1
+DEFAULT_TILE = (8, 8)
+BAND_BYTES = 256*2**20
+
+
+class PixelStore():
+    """
+    Read only run stored tile-major on disk. The sensor is split into tiles
+    and each tile's pixels are stored one after another with every pixel's
+    full time series contiguous, so reading one pixel or one tile over all
+    frames is a single contiguous read. Indexing like a [n_frames, *resolution]
+    array, e.g. store[:, i, j] or store[..., i0:i1, j0:j1], returns arrays in
+    the usual frame-major order so per-pixel kernels can consume it directly.
+    """
+
+    def __init__(self, dirpath, frames=None):
+        """
+        Args:
+            dirpath: str, path of the store directory written by
+                transpose_run
+
+            frames: range, frames of the store in this view, None for all
+        """
+        self.dirpath = dirpath
+        with open(os.path.join(dirpath, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.data_path = os.path.join(dirpath, "data.npy")
+        self.data = np.load(self.data_path, mmap_mode="r")
+        self.tile = tuple(self.meta["tile"])
+        self.resolution = tuple(self.meta["resolution"])
+        if frames == None:
+            frames = range(self.data.shape[-1])
+        self.frames = frames
+        self.dtype = self.data.dtype
+
+    @property
+    def shape(self):
+        return (len(self.frames), *self.resolution)
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __len__(self):
+        return len(self.frames)
+
+    def share_handle(self):
+        """
+        Returns: handle used by tile_tools to open the store in other
+            processes without copying it
+        """
+        return ("store", self.dirpath, self.frames.start, self.frames.stop, \
+            self.frames.step)
+
+    def pixel(self, i, j):
+        """
+        Returns: np.ndarray of the time series of pixel (i, j)
+        """
+        series = self.data[i // self.tile[0], j // self.tile[1], \
+            i % self.tile[0], j % self.tile[1]]
+        return np.asarray(series[self.frame_slice()])
+
+    def frame_slice(self):
+        """
+        Returns: slice of the frames of this view
+        """
+        stop = self.frames.stop
+        if stop < 0:
+            stop = None
+        return slice(self.frames.start, stop, self.frames.step)
+
+    def read(self, rows, cols):
+        """
+        Reads the time series of a rectangle of pixels, one contiguous read
+        per tile
+
+        Args:
+            rows: slice, rows of the sensor to read
+
+            cols: slice, columns of the sensor to read
+
+        Returns: [n_frames, n_rows, n_cols] np.ndarray
+        """
+        i0, i1, _ = rows.indices(self.resolution[0])
+        j0, j1, _ = cols.indices(self.resolution[1])
+        out = np.empty([len(self.frames), max(i1 - i0, 0), max(j1 - j0, 0)], \
+            dtype=self.dtype)
+        tr, tc = self.tile
+        for ti in range(i0 // tr, -(-i1 // tr)):
+            for tj in range(j0 // tc, -(-j1 // tc)):
+                block = self.data[ti, tj][..., self.frame_slice()]
+                # Part of the tile inside the rectangle
+                a0, a1 = max(i0, ti*tr), min(i1, (ti + 1)*tr)
+                b0, b1 = max(j0, tj*tc), min(j1, (tj + 1)*tc)
+                block = block[a0 - ti*tr:a1 - ti*tr, b0 - tj*tc:b1 - tj*tc]
+                out[:, a0 - i0:a1 - i0, b0 - j0:b1 - j0] = \
+                    np.moveaxis(np.asarray(block), -1, 0)
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 0 and key[0] is Ellipsis:
+            key = (slice(None),)*(4 - len(key)) + key[1:]
+        key = key + (slice(None),)*(3 - len(key))
+        frames, rows, cols = key
+        if isinstance(frames, slice) and rows == slice(None) \
+            and cols == slice(None):
+            # Frame selections stay lazy
+            return PixelStore(self.dirpath, frames=self.frames[frames])
+        squeeze = []
+        if isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + 1)
+            squeeze.append(1)
+        if isinstance(cols, (int, np.integer)):
+            cols = slice(cols, cols + 1)
+            squeeze.append(2)
+        if len(squeeze) == 2:
+            values = self.pixel(rows.start, cols.start)[:, None, None]
+        else:
+            values = self.read(rows, cols)
+        if len(squeeze) > 0:
+            values = values.squeeze(axis=tuple(squeeze))
+        return values[frames]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.read(slice(None), slice(None))
+        if dtype != None:
+            values = values.astype(dtype, copy=False)
+        return values
+
+
+def store_path(filepath):
+    """
+    Returns: str; path of the pixel store of the raw run at filepath
+    """
+    return filepath + STORE_EXT
+
+
+def transpose_run(filepath, resolution, dirpath=None, tile=DEFAULT_TILE, \
+    start_frame=0, end_frame=None, band_bytes=BAND_BYTES):
+    """
+    Converts the raw run at filepath into a tile-major PixelStore. The run is
+    read in bands of whole tile rows over all frames, so memory use is
+    bounded by band_bytes and the store is written sequentially.
+
+    Args:
+        filepath: str, path to the raw run
+
+        resolution: array-like, resolution of the sensor, must be divisible
+            by tile
+
+        dirpath: str, path of the store directory, None for store_path
+
+        tile: array-like, (rows, columns) of each tile
+
+        start_frame: int, first frame stored
+
+        end_frame: int, frame to stop at (exclusive), None for all frames
+
+        band_bytes: int, number of bytes read at a time
+
+    Returns: PixelStore class instance of the new store
+    """
+    if resolution[0] % tile[0] != 0 or resolution[1] % tile[1] != 0:
+        raise ValueError("Tile {} does not divide resolution {}"\
+            .format(tile, resolution))
+    if dirpath == None:
+        dirpath = store_path(filepath)
+    im, n_frames = rpt.map_file(filepath, resolution, \
+        start_frame=start_frame, end_frame=end_frame)
+    n_tiles = (resolution[0] // tile[0], resolution[1] // tile[1])
+    os.makedirs(dirpath, exist_ok=True)
+    tmp_path = os.path.join(dirpath, "data.tmp.npy")
+    data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=im.dtype, \
+        shape=(*n_tiles, *tile, n_frames))
+    row_bytes = n_frames*resolution[1]*im.dtype.itemsize
+    band_rows = band_bytes // max(row_bytes, 1)
+    band_tiles = max(band_rows // tile[0], 1)
+    for t0 in range(0, n_tiles[0], band_tiles):
+        t1 = min(t0 + band_tiles, n_tiles[0])
+        band = np.asarray(im[:, t0*tile[0]:t1*tile[0]])
+        band = band.reshape(n_frames, t1 - t0, tile[0], n_tiles[1], tile[1])
+        # [tile row, tile column, row, column, frame]
+        data[t0:t1] = band.transpose(1, 3, 2, 4, 0)
+        del band
+    data.flush()
+    del data
+    os.replace(tmp_path, os.path.join(dirpath, "data.npy"))
+    meta = {"version": STORE_VERSION, "tile": list(tile), \
+        "resolution": list(resolution), \
+        "window": [start_frame, end_frame, 1], \
+        "source": sc.file_identity(filepath)}
+    with open(os.path.join(dirpath, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=1)
+    return PixelStore(dirpath)
+
+
+def get_store_run(name, dirpath):
+    """
+    Creates a Run object whose frame_arr is the PixelStore at dirpath. The
+    run is identified by the identity of the raw run recorded when the store
+    was made, so it shares cached products with that raw run while it is
+    unchanged and keeps working once it is deleted. Its statistics sidecar is
+    kept with the store's data file.
+
+    Returns: Run object
+    """
+    store = PixelStore(dirpath)
+    run = rpt.Run(True, name)
+    run.filepath = store.data_path
+    run.identity = store.meta["source"]
+    run.frame_arr = store
+    run.n_frames = len(store)
+    run.start_frame = 0
+    run.frame_window = tuple(store.meta["window"])
+    run.resolution = store.resolution
+    return run
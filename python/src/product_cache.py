@@ -0,0 +1,273 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+import stats_cache as sc
+
+DEFAULT_MAX_BYTES = 20*2**30
+MANIFEST_EXT = ".json"
+
+
+def identify(obj):
+    """
+    Describes an input of a derived product so that it can be hashed into
+    the product's key
+
+    Args:
+        obj: input to identify, one of
+            str - path to a file, identified by stats_cache.file_identity
+            Run - identified by its file (or recorded identity) and frame
+                window
+            PTC - identified by the contents of its layers and order
+            np.ndarray - identified by its contents
+            anything else that can be written to json as it is
+
+    Returns: json serialisable identity of obj
+    """
+    if isinstance(obj, str) and os.path.isfile(obj):
+        return sc.file_identity(obj)
+    if hasattr(obj, "frame_window") and hasattr(obj, "filepath"):
+        window = obj.frame_window
+        if window == None:
+            window = (obj.start_frame, None, 1)
+        if getattr(obj, "identity", None) != None:
+            return {"run": obj.identity, "window": list(window)}
+        if obj.filepath == None:
+            # Frames only held in memory are identified by their contents
+            frames = getattr(obj, "frame_arr", None)
+            if frames is None:
+                return {"run": obj.name}
+            return {"run": identify(np.asarray(frames[obj.start_frame:])), \
+                "window": list(window)}
+        return {"run": sc.file_identity(obj.filepath), "window": list(window)}
+    if hasattr(obj, "s_mean") and hasattr(obj, "err_tot"):
+        layers = [obj.s_mean, obj.err_tot]
+        if getattr(obj, "order", None) is not None:
+            layers.append(obj.order)
+        return {"ptc": [identify(layer) for layer in layers], \
+            "sorted": bool(obj.sorted)}
+    if isinstance(obj, np.ndarray):
+        sha = hashlib.sha1(np.ascontiguousarray(obj).view(np.uint8))
+        return {"array": sha.hexdigest(), "shape": list(obj.shape), \
+            "dtype": obj.dtype.str}
+    return obj
+
+
+def product_key(product, inputs, params):
+    """
+    Calculates the key of a product
+
+    Args:
+        product: str, name of the product, e.g. "chi2"
+
+        inputs: array-like, inputs of the product, see identify
+
+        params: dict, parameters the product was calculated with
+
+    Returns: tuple of the key and the manifest describing it
+    """
+    manifest = {"product": product, \
+        "inputs": [identify(obj) for obj in inputs], "params": params}
+    text = json.dumps(manifest, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest(), manifest
+
+
+class ProductCache():
+    """
+    Content addressed cache of derived calibration products (offset and noise
+    maps, chi2 values, PT curves, gain maps, ...). Each product is stored
+    under a key hashed from the identities of its inputs and its parameters,
+    together with a json manifest recording them. Entries are written under
+    a temporary name unique to the writer and renamed into place, and an
+    entry only counts as cached once its manifest exists, so processes can
+    share a cache and an interrupted write is simply made again. The least
+    recently used products are evicted once the cache grows beyond
+    max_bytes.
+    """
+
+    def __init__(self, dirpath, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            dirpath: str, directory of the cache, created when first written
+
+            max_bytes: int, size the cache is kept below
+        """
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+
+    def key(self, product, inputs, params):
+        """
+        Calculates the key of a product, see product_key
+        """
+        return product_key(product, inputs, params)
+
+    def path(self, key, ext):
+        """
+        Returns: str; path of the entry for key with extension ext
+        """
+        return os.path.join(self.dirpath, key + ext)
+
+    def lookup(self, key):
+        """
+        Finds the entry for key and marks it as recently used
+
+        Returns: str; path of the entry, or None if it is not cached
+        """
+        if not os.path.isfile(self.path(key, MANIFEST_EXT)):
+            # Not committed, e.g. the write was interrupted
+            return None
+        for path in glob.glob(os.path.join(glob.escape(self.dirpath), \
+            key + ".*")):
+            if path.endswith(MANIFEST_EXT) or ".tmp" in path:
+                continue
+            os.utime(path)
+            return path
+        return None
+
+    def temp_path(self, key, ext, directory=False):
+        """
+        Creates a file (or directory) to write the entry for key in before it
+        is installed, unique to this writer
+
+        Returns: str; path of the temporary entry
+        """
+        os.makedirs(self.dirpath, exist_ok=True)
+        # The temporary files are private to the user, entries are not
+        if directory == True:
+            path = tempfile.mkdtemp(suffix=".tmp" + ext, prefix=key + ".", \
+                dir=self.dirpath)
+            os.chmod(path, 0o755)
+            return path
+        fd, path = tempfile.mkstemp(suffix=".tmp" + ext, prefix=key + ".", \
+            dir=self.dirpath)
+        os.close(fd)
+        os.chmod(path, 0o644)
+        return path
+
+    def install(self, key, ext, tmp_path, manifest):
+        """
+        Renames an entry written to tmp_path (see temp_path) into place and
+        commits it
+        """
+        path = self.path(key, ext)
+        if os.path.isdir(tmp_path):
+            # A directory cannot replace another one, an uncommitted or
+            # identical entry already there is removed first
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another writer installed it in the meantime
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            os.replace(tmp_path, path)
+        self.commit(key, manifest)
+
+    def commit(self, key, manifest):
+        """
+        Records the manifest of an entry that has just been installed at
+        self.path(key, ext) and evicts old entries if the cache is too big
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp" + MANIFEST_EXT, \
+            prefix=key + ".", dir=self.dirpath)
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=1, default=str)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path(key, MANIFEST_EXT))
+        self.evict()
+
+    def load_array(self, key, mmap=False):
+        """
+        Returns: the cached array for key, or None if it is not cached
+        """
+        path = self.lookup(key)
+        if path == None:
+            return None
+        return np.load(path, mmap_mode="r" if mmap == True else None)
+
+    def save_array(self, key, manifest, array):
+        """
+        Caches array under key
+        """
+        tmp_path = self.temp_path(key, ".npy")
+        np.save(tmp_path, array)
+        self.install(key, ".npy", tmp_path, manifest)
+
+    def entries(self):
+        """
+        Returns: list of (last used time, size in bytes, key) of every entry
+        """
+        if not os.path.isdir(self.dirpath):
+            return []
+        entries = []
+        for filename in os.listdir(self.dirpath):
+            key, ext = os.path.splitext(filename)
+            if ext == MANIFEST_EXT or ".tmp" in filename:
+                continue
+            path = os.path.join(self.dirpath, filename)
+            size = os.path.getsize(path)
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    size += sum(os.path.getsize(os.path.join(root, name)) \
+                        for name in files)
+            entries.append((os.path.getmtime(path), size, key))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no bigger
+        than max_bytes
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        """
+        Removes the entry for key and its manifest
+        """
+        for path in glob.glob(os.path.join(glob.escape(self.dirpath), \
+            key + ".*")):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def cached_array(cache, product, inputs, params, compute):
+    """
+    Returns a cached array product, calculating and caching it if it is not
+    cached
+
+    Args:
+        cache: ProductCache class instance, or None to always calculate
+
+        product: str, name of the product
+
+        inputs: array-like, inputs of the product, see identify
+
+        params: dict, parameters of the product
+
+        compute: function, called without arguments to calculate the product
+
+    Returns: np.ndarray of the product
+    """
+    if cache == None:
+        return compute()
+    key, manifest = cache.key(product, inputs, params)
+    array = cache.load_array(key)
+    if array is not None:
+        print("Using cached {} \"{}\"".format(product, key))
+        return array
+    array = compute()
+    cache.save_array(key, manifest, array)
+    return array
@@ -1,50 +1,213 @@
 import os
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 
+import moment_tools as mt
+import product_cache as pc
+import run_path_tools as rpt
+import shared_store as ss
+import smooth_tools
+
 ETS = "Press <enter> to skip"
+PTC_EXT = ".ptc"
+PTC_VERSION = 1
+PTC_LAYERS = ("s_mean", "err_tot")
 # import image_analysis_tools as iat
 
+def order_dtype(n_runs):
+    """
+    Returns: the smallest unsigned integer type that can index n_runs runs
+    """
+    if n_runs <= np.iinfo(np.uint8).max + 1:
+        return np.uint8
+    return np.uint16
+
+
+class SortedLayer:
+    """
+    Read only view of a PT curve layer sorted against average signal
+    individually for each pixel. Nothing is copied until the view is indexed,
+    and then only the indexed pixels are gathered, e.g. view[:, i, j] reads
+    pixel (i, j) only. Supports basic indexing with integers and slices.
+    """
+    __slots__ = ("layer", "order")
+
+    def __init__(self, layer, order):
+        """
+        Args:
+            layer: np.ndarray, [n_runs, *resolution] layer in run order
+
+            order: np.ndarray, [n_runs, *resolution] permutation, order[k] is
+                the run with the k-th smallest average signal of each pixel
+        """
+        self.layer = layer
+        self.order = order
+
+    @property
+    def shape(self):
+        return self.layer.shape
+
+    def __len__(self):
+        return self.layer.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # Select the pixels first so only they are gathered
+        pixels = (slice(None),) + key[1:]
+        values = np.take_along_axis(np.asarray(self.layer[pixels]), \
+            self.order[pixels].astype(np.intp), axis=0)
+        if len(key) == 0:
+            return values
+        return values[key[0]]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        if dtype != None:
+            values = values.astype(dtype, copy=False)
+        return values
+
+
 class PTC:
     """
     Object for organising ptc data
     """
+    __slots__ = ("s_mean", "err_tot", "sorted", "resolution", "sources", \
+        "order")
 
-    def __init__(self, n_runs, resolution, sorting):
+    def __init__(self, n_runs, resolution, sorting, dtype=float):
         """
         Class attributes:
             s_mean: np.ndarray, pixel array of each pixel's arithmetic mean
                 after the offset has been removed (average signal) for each 
-                run in the series 
+                run in the series, in run order
 
             err_tot: np.ndarray, array of each pixel's total noise for each run
-                in the series
-
-            err_fpn: np.ndarray, array of each pixel's fixed pattern noise for
-                each run in the series
-                
-            err_gauss: np.ndarray, array for each pixel's gaussian noise
-                (shot noise) in the series
+                in the series, in run order
             
-            sorted: bool; if set to True each pixel's values have been sorted
-                against s_mean
+            sorted: bool; if set to True each pixel's values are viewed sorted
+                against s_mean, see view
+
+            sources: list; identity of each run already in the PT curve, see
+                get_source
+
+            order: np.ndarray; uint8/uint16 per pixel permutation that sorts
+                each pixel against s_mean, None until index_sort is called.
+                PT curves made before order was added have sorted set and
+                order None, their layers are already in signal order
+
+        Args:
+            dtype: data type of the PT curve arrays, e.g. np.float32 to halve
+                the memory and disk space
         """
-        self.s_mean = np.zeros([n_runs, *resolution], dtype=float)
+        self.s_mean = np.zeros([n_runs, *resolution], dtype=dtype)
         self.err_tot = self.s_mean.copy()
-        self.err_fpn = self.s_mean.copy()
-        self.err_gauss = self.s_mean.copy()
         self.sorted = sorting
-        self.resolution = resolution
-        
+        self.resolution = tuple(resolution)
+        self.sources = []
+        self.order = None
+
+    def __setstate__(self, state):
+        """
+        Restores a pickled PT curve, including ones pickled before __slots__
+        was added whose state is a dict holding the unused err_fpn and
+        err_gauss arrays
+        """
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+        self.sources = []
+        self.order = None
+        for key in self.__slots__:
+            if key in state:
+                setattr(self, key, state[key])
+        self.resolution = tuple(self.resolution)
+
+    def view(self, layer):
+        """
+        Returns the layer in signal order if the PT curve is sorted, otherwise
+        in run order. Sorted layers are returned as a lazy SortedLayer so no
+        copy of the layer is made.
+
+        Args:
+            layer: str, "s_mean" or "err_tot"
+        """
+        if self.sorted == True and self.order is not None:
+            return SortedLayer(getattr(self, layer), self.order)
+        return getattr(self, layer)
+
+    def get_rank(self):
+        """
+        Returns: [n_runs, *resolution] array of the position of each run in
+            its pixel's signal order, the inverse of order. If the PT curve
+            has no order the layers are already in the order that is used
+        """
+        if self.order is None:
+            index = np.arange(self.s_mean.shape[0], \
+                dtype=order_dtype(self.s_mean.shape[0]))
+            return np.broadcast_to(index.reshape(-1, 1, 1), self.s_mean.shape)
+        rank = np.empty(self.order.shape, dtype=self.order.dtype)
+        index = np.arange(self.order.shape[0], dtype=self.order.dtype)
+        np.put_along_axis(rank, self.order.astype(np.intp), \
+            index.reshape(-1, 1, 1), axis=0)
+        return rank
+
+    def add_layers(self, s_mean, err_tot, sources):
+        """
+        Appends the layers of new runs to the end of the PT curve arrays. If
+        the PT curve has an order it is updated incrementally, the existing
+        layers are only compared against the new ones and never gathered.
+
+        Args:
+            s_mean: np.ndarray, [n_new, *resolution] average signal layers
+
+            err_tot: np.ndarray, [n_new, *resolution] total noise layers
+
+            sources: list, identity of each new run
+        """
+        dtype = self.s_mean.dtype
+        n_old = self.s_mean.shape[0]
+        if self.sorted == True and self.order is None:
+            # Layers of old PT curves are already in signal order
+            self.order = np.array(self.get_rank())
+        n_new = s_mean.shape[0]
+        if self.order is not None:
+            rank = self.get_rank().astype(order_dtype(n_old + n_new))
+            new_rank = np.zeros(s_mean.shape, dtype=rank.dtype)
+            for i in range(n_old):
+                # New runs go after old runs with equal signal
+                new_rank += self.s_mean[i] <= s_mean
+                rank[i] += (s_mean < self.s_mean[i]).sum(axis=0, \
+                    dtype=rank.dtype)
+            for i in range(n_new):
+                new_rank[i] += (s_mean < s_mean[i]).sum(axis=0, \
+                    dtype=rank.dtype)
+                new_rank[i] += (s_mean[:i] == s_mean[i]).sum(axis=0, \
+                    dtype=rank.dtype)
+            rank = np.concatenate([rank, new_rank])
+            self.order = np.empty(rank.shape, dtype=rank.dtype)
+            index = np.arange(rank.shape[0], dtype=rank.dtype)
+            np.put_along_axis(self.order, rank.astype(np.intp), \
+                index.reshape(-1, 1, 1), axis=0)
+        self.s_mean = np.concatenate([self.s_mean, s_mean]).astype(dtype, \
+            copy=False)
+        self.err_tot = np.concatenate([self.err_tot, err_tot]).astype(dtype, \
+            copy=False)
+        self.sources = self.sources + list(sources)
+
     
     def index_sort(self, index, axis=-1):
         """
-        Sorts all arrays against index locally. NOTE: THIS MAY SORT EACH PIXEL
-        DIFFERENTLY MEANING THAT IT IS NO LONGER POSSIBLE TO ANALYSE CLUSERS 
-        OF PIXELS DIRECTLY. ONE MUST INSTEAD CALCULATE VALUES FROM EACH PIXEL'S
-        PTC INDEPENDETLY AND THEN COMPARE THEM !!!
+        Sorts all arrays against index locally by storing index as the PT
+        curve's order. The layers keep their run order and are viewed sorted
+        with view. NOTE: THIS MAY SORT EACH PIXEL DIFFERENTLY MEANING THAT IT
+        IS NO LONGER POSSIBLE TO ANALYSE CLUSERS OF PIXELS DIRECTLY FROM THE
+        SORTED VIEW. ONE MUST INSTEAD CALCULATE VALUES FROM EACH PIXEL'S PTC
+        INDEPENDETLY AND THEN COMPARE THEM !!!
 
         Args:
             index: array-like, index to sort all arrays against. NOTE: this
@@ -52,11 +215,9 @@ class PTC:
 
             axis: int, axis along which index was sorted
         """
-        if index.shape == self.s_mean.argsort(axis=axis).shape:
-            self.s_mean = np.take_along_axis(self.s_mean, index, axis=0)
-            self.err_tot = np.take_along_axis(self.err_tot, index, axis=0)
-            # self.err_fpn = np.take_along_axis(self.err_fpn, index, axis=0)
-            # self.err_gauss = np.take_along_axis(self.err_gauss, index, axis=0)
+        if index.shape == self.s_mean.shape and axis == 0:
+            self.order = index.astype(order_dtype(index.shape[0]))
+            self.sorted = True
         else:
             print("Error: index shape and axes do not match ptc arrays")
             exit()
@@ -66,18 +227,18 @@ class PTC:
         """
         self.s_mean = self.s_mean.reshape(-1)
         self.err_tot = self.err_tot.reshape(-1)
-        self.err_fpn = self.err_fpn.reshape(-1)
-        self.err_gauss = self.err_gauss.reshape(-1)
 
 
-def get_ptc(datasets, offset, read_error, resolution, sort=False):
+def get_ptc(datasets, offset, read_error, resolution, sort=False, \
+    chunk=mt.DEFAULT_CHUNK, dtype=float, cache=None, workers=1):
     """
     Calculates all required parameters a photon transfer curve and stores them
     in a PTC object.
 
     Args:
-        datasets: array-like, collection of Run objects corresponding to the
-            run data used to calculate the photon transfer curve
+        datasets: array-like, collection of Run (or shared_store.SharedRun)
+            objects corresponding to the run data used to calculate the
+            photon transfer curve
 
         offset: array-like, pixel array of offset (dark values) for each
             individual pixel in the sensor.
@@ -91,32 +252,367 @@ def get_ptc(datasets, offset, read_error, resolution, sort=False):
             sorted against average signal INDIVIDUALLY FOR EACH PIXEL. This
             means that each [n, :, :] subarray may no longer contain data from
             a single run 
+
+        chunk: int, number of frames of each run read at a time. Each run is
+            reduced chunk by chunk so peak memory is one chunk plus the PTC
+            arrays, however many frames a run has
+
+        dtype: data type of the PT curve arrays
+
+        cache: ProductCache, if given a PT curve already made from the same
+            runs, offset and parameters is reused
+
+        workers: int, number of runs reduced at once. With more than one
+            worker the frames of each run without statistics are published
+            once with shared_store and reduced in a process pool
         
-    Returns: PTC object containing the average signal, total noise, fixed
-        pattern noise, and shot noise for each pixel over a single run 
-        for all runs.
+    Returns: PTC object containing the average signal and total noise for
+        each pixel over a single run for all runs.
     """
+    if cache != None:
+        return cached_ptc(cache, [*datasets, np.asarray(offset)], \
+            {"sort": sort, "dtype": np.dtype(dtype).str}, \
+            lambda: get_ptc(datasets, offset, read_error, resolution, \
+            sort=sort, chunk=chunk, dtype=dtype, workers=workers))
     n_runs = len(datasets)
-    ptc = PTC(n_runs=n_runs, resolution=resolution, sorting=sort)
+    ptc = PTC(n_runs=n_runs, resolution=resolution, sorting=sort, dtype=dtype)
     # Determine values for each run individually
-    for i in range(n_runs):
-        run = datasets[i]
-        # Remove offset and determine average signal for each pixel
-        raw = run.frame_arr.copy().astype(dtype=np.int64, copy=False)
-        ptc.s_mean[i] = raw[run.start_frame:].mean(axis=0) - offset
-        ptc.err_tot[i] = (raw[run.start_frame:] -offset).var(axis=0)
+    if workers == 1:
+        for i in range(n_runs):
+            run = datasets[i]
+            ptc.s_mean[i], ptc.err_tot[i] = get_ptc_layer(run, offset, \
+                chunk=chunk)
+    else:
+        published = []
+        try:
+            with ProcessPoolExecutor(max_workers=workers, \
+                mp_context=ss.pool_context()) as pool:
+                layers = {}
+                for i, run in enumerate(datasets):
+                    if isinstance(run, ss.SharedRun):
+                        layers[i] = pool.submit(get_ptc_layer, run, offset, \
+                            chunk)
+                    elif run.stats != None:
+                        # Layers from statistics are cheap, sending the run
+                        # to a worker would cost more than making them here
+                        ptc.s_mean[i], ptc.err_tot[i] = get_ptc_layer(run, \
+                            offset, chunk)
+                    else:
+                        published.append(ss.publish_run(run))
+                        layers[i] = pool.submit(get_ptc_layer, \
+                            published[-1], offset, chunk)
+                for i, layer in layers.items():
+                    ptc.s_mean[i], ptc.err_tot[i] = layer.result()
+        finally:
+            for run in published:
+                run.close()
         # # Remove fixed pattern noise and determine gaussian noise
         # err_gauss = np.zeros(run.resolution, dtype=float)
         # for j in range(run.start_frame, run.n_frames, 1):
         #     err_gauss = err_gauss + np.square(raw[j] - raw[j-1])
         # ptc.err_gauss[i] = np.sqrt(err_gauss/(2*u_frames)) 
+    ptc.sources = [get_source(run) for run in datasets]
     # Sort arrays against s_mean if sort == True
     if sort == True:
-        index = ptc.s_mean.argsort(axis=0, kind="quicksort")
+        index = ptc.s_mean.argsort(axis=0, kind="stable")
+        ptc.index_sort(index, axis=0)
+    return ptc
+
+
+def cached_ptc(cache, inputs, params, compute):
+    """
+    Returns a PT curve from cache, calculating and caching it in the PTC
+    storage format if it is not cached
+
+    Args:
+        cache: ProductCache class instance
+
+        inputs: array-like, inputs of the PT curve, see product_cache.identify
+
+        params: dict, parameters of the PT curve
+
+        compute: function, called without arguments to calculate the PT curve
+
+    Returns: PTC class instance
+    """
+    key, manifest = cache.key("ptc", inputs, params)
+    entry = cache.lookup(key)
+    if entry != None:
+        print("Using cached PT curve \"{}\"".format(key))
+        return read_ptc(entry)
+    pt_curve = compute()
+    if pt_curve != None:
+        tmp_path = cache.temp_path(key, PTC_EXT, directory=True)
+        write_ptc(pt_curve, tmp_path)
+        cache.install(key, PTC_EXT, tmp_path, manifest)
+    return pt_curve
+
+
+def get_ptc_layer(run, offset, chunk=mt.DEFAULT_CHUNK, cache_dir=None):
+    """
+    Calculates the average signal and total noise of each pixel for one run.
+    The run's statistics sidecar is used if it is valid, see
+    run_path_tools.get_run_stats.
+
+    Args:
+        run: Run or shared_store.SharedRun class instance
+
+        offset: array-like, pixel array of offset (dark values)
+
+        chunk: int, number of frames read at a time
+
+        cache_dir: str, directory of the statistics sidecars, None for next
+            to the run
+
+    Returns: tuple of the average signal and total noise pixel arrays
+    """
+    run = ss.as_run(run)
+    # Remove offset and determine average signal for each pixel, the offset
+    # does not change the variance
+    stats = rpt.get_run_stats(run, cache_dir=cache_dir, chunk=chunk)
+    return stats.mean() - offset, stats.var()
+
+
+def file_ptc_layer(filepath, offset, resolution, start_frame=0, \
+    end_frame=None, chunk=mt.DEFAULT_CHUNK, cache_dir=None):
+    """
+    Calculates the average signal and total noise of each pixel for the raw
+    run at filepath. Used by the worker processes of get_ptc_dir, which only
+    send back the two small pixel arrays.
+
+    Returns: tuple of the average signal and total noise pixel arrays
+    """
+    stats = rpt.get_file_stats(filepath, resolution, start_frame=start_frame, \
+        end_frame=end_frame, cache_dir=cache_dir, chunk=chunk)
+    return stats.mean() - offset, stats.var()
+
+
+def get_ptc_dir(dirpath, offset, resolution, run_id="", sort=False, \
+    start_frame=0, end_frame=None, workers=1, chunk=mt.DEFAULT_CHUNK, \
+    dtype=float, cache_dir=None, cache=None):
+    """
+    Calculates a PT curve straight from the raw runs in a directory without
+    loading them as Run objects first. With one worker the next run is
+    streamed from its memory map on a background thread while the current
+    one is, so memory stays bounded by the chunk size. With more workers
+    several runs are reduced at once in a process pool. Runs with a
+    valid statistics sidecar are not read at all.
+
+    Args:
+        dirpath: str, directory containing the raw runs
+
+        offset: array-like, pixel array of offset (dark values)
+
+        resolution: array-like, dim(2) array containing the sensor resolution
+
+        run_id: str, identifier that filenames of the runs must contain
+
+        sort: bool, if set to True each pixel is sorted against average signal,
+            see get_ptc
+
+        start_frame: int, first useful frame of each run
+
+        end_frame: int, frame to stop at in each run (exclusive)
+
+        workers: int, number of runs reduced at once
+
+        chunk: int, number of frames read at a time
+
+        dtype: data type of the PT curve arrays
+
+        cache_dir: str, directory of the statistics sidecars, None for next
+            to each run
+
+        cache: ProductCache, if given a PT curve already made from the same
+            runs, offset and parameters is reused
+
+    Returns: PTC object, or None if no runs were found
+    """
+    filepaths = rpt.find_run_files(dirpath, run_id)
+    if len(filepaths) == 0:
+        print("Error: no runs matching \"{}\" in \"{}\", aborting!"\
+            .format(run_id, dirpath))
+        return None
+    if cache != None:
+        return cached_ptc(cache, [*filepaths, np.asarray(offset)], \
+            {"sort": sort, "start_frame": start_frame, \
+            "end_frame": end_frame, "dtype": np.dtype(dtype).str}, \
+            lambda: get_ptc_dir(dirpath, offset, resolution, run_id=run_id, \
+            sort=sort, start_frame=start_frame, end_frame=end_frame, \
+            workers=workers, chunk=chunk, dtype=dtype, cache_dir=cache_dir))
+    n_runs = len(filepaths)
+    ptc = PTC(n_runs=n_runs, resolution=resolution, sorting=sort, dtype=dtype)
+    if workers == 1:
+        def reduce(filepath):
+            # Streams the memory mapped run a chunk at a time, the sidecar
+            # replaces reading it when it is valid
+            return rpt.get_file_stats(filepath, resolution, \
+                start_frame=start_frame, end_frame=end_frame, \
+                cache_dir=cache_dir, chunk=chunk)
+        # The next run is reduced while the current one is, so at most two
+        # chunks are in memory rather than a whole run
+        with ThreadPoolExecutor(max_workers=2) as prefetch:
+            pending = [prefetch.submit(reduce, filepath) \
+                for filepath in filepaths[:2]]
+            for i in range(n_runs):
+                stats = pending[i].result()
+                pending[i] = None
+                if i + 2 < n_runs:
+                    pending.append(prefetch.submit(reduce, filepaths[i + 2]))
+                ptc.s_mean[i] = stats.mean() - offset
+                ptc.err_tot[i] = stats.var()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, \
+            mp_context=ss.pool_context()) as pool:
+            layers = [pool.submit(file_ptc_layer, filepath, offset, \
+                resolution, start_frame, end_frame, chunk, cache_dir) \
+                for filepath in filepaths]
+            for i in range(n_runs):
+                ptc.s_mean[i], ptc.err_tot[i] = layers[i].result()
+    ptc.sources = [os.path.abspath(filepath) for filepath in filepaths]
+    if sort == True:
+        index = ptc.s_mean.argsort(axis=0, kind="stable")
         ptc.index_sort(index, axis=0)
     return ptc
 
 
+def get_source(run):
+    """
+    Returns: str; identity of run recorded in PTC.sources, the absolute path
+        of its raw file or its name if it was not loaded from a file
+    """
+    if getattr(run, "identity", None) != None:
+        return run.identity["path"]
+    if run.filepath == None:
+        return run.name
+    return os.path.abspath(run.filepath)
+
+
+def add_runs(ptc, datasets, offset, chunk=mt.DEFAULT_CHUNK):
+    """
+    Adds new illumination levels to an existing PT curve. Runs that are
+    already in ptc.sources are skipped without being read. If the PT curve is
+    sorted its order is updated to include the new levels.
+
+    Args:
+        ptc: PTC class instance, PT curve to add to
+
+        datasets: array-like, collection of Run objects
+
+        offset: array-like, pixel array of offset (dark values), this must be
+            the offset the PT curve was built with
+
+        chunk: int, number of frames read at a time
+
+    Returns: int; the number of runs that were added
+    """
+    if not hasattr(ptc, "sources"):
+        # PT curves pickled before sources were recorded
+        ptc.sources = []
+    new_runs = []
+    for run in datasets:
+        source = get_source(run)
+        if source in ptc.sources or source in map(get_source, new_runs):
+            print("Run \"{}\" is already in the PT curve, skipping".format(\
+                source))
+            continue
+        new_runs.append(run)
+    if len(new_runs) == 0:
+        return 0
+    s_mean = np.zeros([len(new_runs), *ptc.resolution], \
+        dtype=ptc.s_mean.dtype)
+    err_tot = s_mean.copy()
+    for i in range(len(new_runs)):
+        s_mean[i], err_tot[i] = get_ptc_layer(new_runs[i], offset, chunk=chunk)
+    ptc.add_layers(s_mean, err_tot, map(get_source, new_runs))
+    return len(new_runs)
+
+
+def fit_ptc(ptc, cutoff):
+    """
+    Fits a straight line err_tot = a*s_mean + b to every pixel's PT curve
+    at once with the closed form least squares solution. Only the points
+    before each pixel's own cutoff index are used, the cutoff indexes the
+    sorted view of sorted PT curves so the layers never have to be gathered.
+
+    Args:
+        ptc: PTC class instance, PT curve to fit
+
+        cutoff: array-like, pixel array of the index of the first point that
+            is excluded from each pixel's fit, e.g. the full well peak.
+            Pixels with fewer than 2 points are not fitted and left as 0
+
+    Returns: tuple of
+        parameters: [2, *resolution] array of the slope (dim 0) and intercept
+            (dim 1) of each pixel
+        errors: [2, *resolution] array of the std. error of the slope and
+            intercept, as given by the covariance of scipy's curve_fit
+        residuals: [n_runs, *resolution] array of each point's residual in
+            run order, 0 for points after the cutoff
+    """
+    x = np.asarray(ptc.s_mean, dtype=np.float64)
+    y = np.asarray(ptc.err_tot, dtype=np.float64)
+    if ptc.sorted == True:
+        mask = ptc.get_rank() < cutoff
+    else:
+        mask = np.arange(x.shape[0]).reshape(-1, *[1]*(x.ndim - 1)) < cutoff
+    n = mask.sum(axis=0)
+    fitted = n >= 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Centre on each pixel's means to keep the sums well conditioned
+        x_mean = np.where(mask, x, 0).sum(axis=0) / n
+        y_mean = np.where(mask, y, 0).sum(axis=0) / n
+        dx = np.where(mask, x - x_mean, 0)
+        dy = np.where(mask, y - y_mean, 0)
+        sxx = np.square(dx).sum(axis=0)
+        slope = (dx*dy).sum(axis=0) / sxx
+        intercept = y_mean - slope*x_mean
+        residuals = np.where(mask, y - slope*x - intercept, 0)
+        res_var = np.square(residuals).sum(axis=0) / (n - 2)
+        slope_err = np.sqrt(res_var / sxx)
+        intercept_err = np.sqrt(res_var*(1/n + np.square(x_mean)/sxx))
+    parameters = np.where(fitted, np.stack([slope, intercept]), 0)
+    errors = np.where(fitted, np.stack([slope_err, intercept_err]), 0)
+    return parameters, errors, residuals
+
+
+def get_gain_maps(ptc, smooth=3, cache=None):
+    """
+    Calculates the gain, read noise and full well capacity of every pixel.
+    The full well peak is found on the smoothed total noise, see
+    smooth_tools.find_peak, and each pixel's PT curve is fitted up to it.
+    The total noise is a variance, so the fit's slope is the inverse gain
+    and its intercept the read noise squared. The read noise and full well
+    (the average signal at the peak) are converted to electrons with the
+    gain.
+
+    Args:
+        ptc: PTC class instance
+
+        smooth: int, number of points either side of each point in the
+            moving average used to find the peak
+
+        cache: ProductCache, if given maps already made from the same PT
+            curve and smoothing are reused
+
+    Returns: tuple of the gain (e-/ADU), read noise (e-, nan where the
+        intercept is negative) and full well (e-) pixel arrays
+    """
+    def compute():
+        peak = smooth_tools.find_peak(ptc.view("err_tot"), smooth=smooth, \
+            axis=0)
+        parameters = fit_ptc(ptc, peak)[0]
+        signal = np.take_along_axis(np.asarray(ptc.view("s_mean")), \
+            peak[np.newaxis], axis=0)[0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gain = 1/parameters[0]
+            read_noise = np.sqrt(parameters[1])*gain
+        return np.stack([gain, read_noise, signal*gain])
+    maps = pc.cached_array(cache, "gain", [ptc], {"smooth": smooth, \
+        "units": "e-"}, compute)
+    return maps[0], maps[1], maps[2]
+
+
 def graph_err_tot(ptc, axes, pixel, colour="g"):
     """
     Plot the total error against average signal.
@@ -134,20 +630,9 @@ def graph_err_tot(ptc, axes, pixel, colour="g"):
 
 
 def graph_err_smooth(ptc, axes, pixel, smooth=1, colour="r"):
-    smootherr = ptc.err_tot[:, pixel[0], pixel[1]]
-    n_frames = smootherr.shape[0]
-    for i in range(n_frames):
-            frame_avg = 0
-            for j in range(2*smooth + 1):
-                k = i + j - smooth
-                if k < 0:
-                    k = 0
-                elif k > n_frames - 1:
-                    k = n_frames - 1
-                frame_avg += smootherr[k]
-            frame_avg /= 2*smooth + 1
-            smootherr[i] = frame_avg
-    axes.plot(ptc.s_mean[:, pixel[0], pixel[1]], smootherr, color=colour, label="Total noise (smoothed)")
+    smootherr = smooth_tools.moving_average(\
+        ptc.view("err_tot")[:, pixel[0], pixel[1]], smooth)
+    axes.plot(ptc.view("s_mean")[:, pixel[0], pixel[1]], smootherr, color=colour, label="Total noise (smoothed)")
 
     
 
@@ -273,14 +758,105 @@ def graph_ptc(ptc):
     ax.legend()
     plt.show()
 
+def write_ptc(pt_curve, dirpath):
+    """
+    Writes a PT curve to a directory in the PTC storage format. Each layer is
+    an uncompressed .npy file so it can be memory mapped by read_ptc, and
+    the sorting, resolution and sources are kept in meta.json.
+
+    Args:
+        pt_curve: PTC class instance, PT curve to write
+
+        dirpath: str, path of the PT curve directory, created if missing
+    """
+    os.makedirs(dirpath, exist_ok=True)
+
+    def replace(filename, write):
+        # Write next to the old file under a name unique to this writer and
+        # swap, so a crash never leaves a half written file behind
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=dirpath)
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, os.path.join(dirpath, filename))
+
+    for layer in PTC_LAYERS:
+        replace(f"{layer}.npy", \
+            lambda f: np.save(f, np.asarray(getattr(pt_curve, layer))))
+    if pt_curve.order is not None:
+        replace("order.npy", lambda f: np.save(f, np.asarray(pt_curve.order)))
+    elif os.path.isfile(os.path.join(dirpath, "order.npy")):
+        os.remove(os.path.join(dirpath, "order.npy"))
+    meta = {"version": PTC_VERSION, "sorted": bool(pt_curve.sorted), \
+        "resolution": list(pt_curve.resolution), \
+        "sources": list(pt_curve.sources)}
+    replace("meta.json", lambda f: f.write(json.dumps(meta, indent=1)\
+        .encode()))
+
+
+def read_ptc(dirpath, mmap=True):
+    """
+    Reads a PT curve written by write_ptc
+
+    Args:
+        dirpath: str, path of the PT curve directory
+
+        mmap: bool, if set to True the layers are memory mapped read only, so
+            plotting or fitting a single pixel only reads that pixel's bytes
+
+    Returns: PTC class instance
+    """
+    with open(os.path.join(dirpath, "meta.json")) as f:
+        meta = json.load(f)
+    pt_curve = PTC.__new__(PTC)
+    mmap_mode = "r" if mmap == True else None
+    for layer in PTC_LAYERS:
+        setattr(pt_curve, layer, np.load(os.path.join(dirpath, \
+            f"{layer}.npy"), mmap_mode=mmap_mode))
+    order_path = os.path.join(dirpath, "order.npy")
+    pt_curve.order = None
+    if os.path.isfile(order_path):
+        pt_curve.order = np.load(order_path, mmap_mode=mmap_mode)
+    pt_curve.sorted = meta["sorted"]
+    pt_curve.resolution = tuple(meta["resolution"])
+    pt_curve.sources = meta["sources"]
+    return pt_curve
+
+
+def convert_ptc_object(filepath, dirpath=None, dtype=None):
+    """
+    Converts a PT curve pickled by older versions of save_ptc_object to the
+    PTC storage format, dropping the unused err_fpn and err_gauss arrays
+
+    Args:
+        filepath: str, path of the pickled PT curve
+
+        dirpath: str, path of the new PT curve directory, if None then the
+            extension of filepath is replaced with .ptc
+
+        dtype: data type to store the layers as, e.g. np.float32. If None the
+            original data type is kept
+
+    Returns: str; the path of the new PT curve directory
+    """
+    if dirpath == None:
+        dirpath = os.path.splitext(filepath)[0] + PTC_EXT
+    pt_curve = load_ptc_object(filepath, mmap=False)
+    if dtype != None:
+        for layer in PTC_LAYERS:
+            setattr(pt_curve, layer, getattr(pt_curve, layer).astype(dtype))
+    write_ptc(pt_curve, dirpath)
+    return dirpath
+
+
 def save_ptc_object(pt_curve, src_path):
     """
     Asks the user to input a filename for a pt curve. If filepath is available,
-    saves the pt curve
+    saves the pt curve in the PTC storage format, see write_ptc
 
     Parameters
     ----------
-    pt_curve : ndarray
+    pt_curve : PTC
         ptc curve to be saved
     """
     while True:
@@ -290,12 +866,69 @@ def save_ptc_object(pt_curve, src_path):
         if filename == "":
             return
         else:
-            filename = f"{filename}.npy"
+            filename = f"{filename}{PTC_EXT}"
         parent_dirpath = os.path.split(src_path)[0]
         filepath = os.path.join(parent_dirpath, "lib", "PT_curves", filename)
-        if os.path.isfile(filepath):
+        if os.path.exists(filepath):
             print(f"Error: filename '{filename}' aready in use")
             continue
-        with open(filepath, "wb") as f:
-            pickle.dump(pt_curve, f, protocol=pickle.HIGHEST_PROTOCOL)
-            return
\ No newline at end of file
+        write_ptc(pt_curve, filepath)
+        return
+
+
+def load_ptc_object(filepath, mmap=True):
+    """
+    Loads a PT curve saved with save_ptc_object, either in the PTC storage
+    format or pickled by older versions
+
+    Args:
+        filepath: str; path to the saved PT curve
+
+        mmap: bool; memory map the layers, see read_ptc. Pickled PT curves are
+            always read into memory
+
+    Returns: PTC class instance
+    """
+    if os.path.isdir(filepath):
+        return read_ptc(filepath, mmap=mmap)
+    with open(filepath, "rb") as f:
+        pt_curve = pickle.load(f)
+    return pt_curve
+
+
+def update_ptc_object(datasets, offset, src_path, chunk=mt.DEFAULT_CHUNK):
+    """
+    Asks the user to input the filename of a saved PT curve, adds the runs in
+    datasets that are not already part of it with add_runs and saves it back
+    in the PTC storage format. Pickled PT curves are converted on the way.
+
+    Args:
+        datasets: array-like, collection of Run objects
+
+        offset: array-like, pixel array of offset (dark values)
+
+        src_path: str, path to src
+
+    Returns: the updated PTC class instance, or None if aborted
+    """
+    ptc_dirpath = os.path.join(os.path.split(src_path)[0], "lib", "PT_curves")
+    while True:
+        print("Enter filename of PTC object to update")
+        print(ETS)
+        filename = input()
+        if filename == "":
+            return None
+        filepath = os.path.join(ptc_dirpath, f"{filename}{PTC_EXT}")
+        if os.path.isdir(filepath):
+            break
+        # PT curves pickled before the PTC storage format
+        filepath = os.path.join(ptc_dirpath, f"{filename}.npy")
+        if os.path.isfile(filepath):
+            break
+        print(f"Error: could not find PT curve '{filename}'")
+    pt_curve = load_ptc_object(filepath, mmap=False)
+    n_added = add_runs(pt_curve, datasets, offset, chunk=chunk)
+    print(f"Added {n_added} runs to PT curve '{filename}'")
+    if n_added > 0:
+        write_ptc(pt_curve, os.path.join(ptc_dirpath, f"{filename}{PTC_EXT}"))
+    return pt_curve
@@ -0,0 +1,317 @@
+import os
+import json
+import zlib
+import lzma
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+MAGIC = b"RAWZ"
+CODEC_EXT = ".rawz"
+CODEC_VERSION = 1
+DEFAULT_CHUNK = 16
+# Decoded chunks kept per process, shared by every view of a run so tiles
+# of the same frames do not decode them again
+CHUNK_CACHE_BYTES = 64*2**20
+COMPRESSORS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), \
+        lzma.decompress)}
+chunk_cache = OrderedDict()
+chunk_cache_lock = threading.Lock()
+
+
+def is_compressed(filepath):
+    """
+    Returns: bool; True if the file at filepath is a compressed run
+    """
+    try:
+        with open(filepath, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def encode_chunk(frames):
+    """
+    Encodes a chunk of whole frames (metadata pixels included) losslessly
+    into bytes that compress well. The rounded mean of the chunk is
+    subtracted from every frame, the residuals are zigzag encoded so small
+    negative values stay small and the bytes are shuffled so the mostly zero
+    high bytes sit together.
+
+    Args:
+        frames: [n_frames, pix_per_frame] uint16 np.ndarray
+
+    Returns: bytes of the encoded chunk
+    """
+    ref = np.rint(frames.mean(axis=0)).astype(np.uint16)
+    residual = (frames - ref).view(np.int16)
+    zigzag = ((residual << 1) ^ (residual >> 15)).view(np.uint16)
+    words = np.concatenate([ref, zigzag.ravel()])
+    return words.view(np.uint8).reshape(-1, 2).T.tobytes()
+
+
+def decode_chunk(data, n_frames):
+    """
+    Inverts encode_chunk
+
+    Returns: [n_frames, pix_per_frame] uint16 np.ndarray
+    """
+    words = np.frombuffer(data, dtype=np.uint8).reshape(2, -1).T.copy()\
+        .view(np.uint16).ravel()
+    ref = words[:len(words) // (n_frames + 1)]
+    zigzag = words[len(ref):].reshape(n_frames, len(ref))
+    residual = (zigzag >> 1) ^ (0 - (zigzag & 1)).astype(np.uint16)
+    return residual + ref
+
+
+class CompressedRun():
+    """
+    Read only run stored in a compressed run file written by encode_run.
+    Frames are decoded a chunk at a time, so any frame can be read without
+    decoding the frames before it. Indexing like a [n_frames, *resolution]
+    array returns decoded frames, frame slices stay lazy like a memory mapped
+    run so chunked readers only ever hold a few frames in memory. Indexing
+    pixels as well, e.g. run[..., i0:i1, j0:j1], decodes a chunk at a time
+    and only keeps the wanted pixels.
+    """
+
+    def __init__(self, filepath, frames=None):
+        """
+        Args:
+            filepath: str, path to the compressed run
+
+            frames: range, data frames in this view (the metadata frame is
+                not counted), None for all
+        """
+        self.filepath = filepath
+        with open(filepath, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("\"{}\" is not a compressed run"\
+                    .format(filepath))
+            length = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+            self.meta = json.loads(f.read(length).decode())
+            f.seek(-8, os.SEEK_END)
+            index_offset = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            f.seek(index_offset)
+            n_blobs = self.meta["n_chunks"] + 2
+            self.index = np.frombuffer(f.read(n_blobs*16), dtype="<u8")\
+                .reshape(n_blobs, 2)
+        self.resolution = tuple(self.meta["resolution"])
+        self.chunk = self.meta["chunk"]
+        self.pix_per_frame = self.resolution[0]*self.resolution[1] + 2
+        self.decompress = COMPRESSORS[self.meta["compressor"]][1]
+        if frames == None:
+            frames = range(self.meta["n_frames"] - 1)
+        self.frames = frames
+        self.dtype = np.dtype(np.uint16)
+
+    @property
+    def shape(self):
+        return (len(self.frames), *self.resolution)
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __len__(self):
+        return len(self.frames)
+
+    def share_handle(self):
+        """
+        Returns: handle used by tile_tools to open the run in other processes
+        """
+        return ("rawz", self.filepath, self.frames.start, self.frames.stop, \
+            self.frames.step)
+
+    def read_blob(self, i):
+        """
+        Returns: decompressed bytes of blob i, 0 is the metadata frame, 1 to
+            n_chunks are the frame chunks and the last is any trailing bytes
+        """
+        offset, length = self.index[i]
+        with open(self.filepath, "rb") as f:
+            f.seek(int(offset))
+            return self.decompress(f.read(int(length)))
+
+    def read_chunk(self, i):
+        """
+        Returns: [n_frames, pix_per_frame] uint16 np.ndarray of the whole
+            frames in chunk i, counting the metadata frame as frame 0. The
+            most recently decoded chunks are kept in chunk_cache up to
+            CHUNK_CACHE_BYTES
+        """
+        key = (os.path.abspath(self.filepath), *map(int, self.index[i + 1]))
+        with chunk_cache_lock:
+            if key in chunk_cache:
+                chunk_cache.move_to_end(key)
+                return chunk_cache[key]
+        n_frames = min(self.chunk, self.meta["n_frames"] - 1 - i*self.chunk)
+        frames = decode_chunk(self.read_blob(i + 1), n_frames)
+        frames.flags.writeable = False
+        with chunk_cache_lock:
+            chunk_cache[key] = frames
+            total = sum(chunk.nbytes for chunk in chunk_cache.values())
+            while total > CHUNK_CACHE_BYTES and len(chunk_cache) > 1:
+                _, chunk = chunk_cache.popitem(last=False)
+                total -= chunk.nbytes
+        return frames
+
+    def read(self, frames, pixels=()):
+        """
+        Decodes the data frames in frames
+
+        Args:
+            frames: array-like, indices of the data frames to read
+
+            pixels: tuple, index of the pixels of each frame to keep, e.g.
+                (slice(i0, i1), slice(j0, j1)), () for all
+
+        Returns: [n_frames, ...] uint16 np.ndarray of the pixels
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        pixels = (slice(None), *pixels)
+        # Shape of the kept pixels, found without allocating a frame
+        shape = np.broadcast_to(np.uint16(0), (1, *self.resolution))\
+            [pixels].shape[1:]
+        out = np.empty([len(frames), *shape], dtype=np.uint16)
+        chunk_ids = frames // self.chunk
+        for i in np.unique(chunk_ids):
+            decoded = self.read_chunk(int(i))
+            wanted = np.nonzero(chunk_ids == i)[0]
+            # Pixels first, so only they are copied
+            kept = decoded[:, 2:].reshape(len(decoded), \
+                *self.resolution)[pixels]
+            out[wanted] = kept[frames[wanted] - i*self.chunk]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 0 and key[0] is Ellipsis:
+            key = (slice(None),)*(4 - len(key)) + key[1:]
+        frames, rest = key[0], key[1:]
+        if isinstance(frames, slice):
+            view = CompressedRun.__new__(CompressedRun)
+            view.__dict__.update(self.__dict__)
+            view.frames = self.frames[frames]
+            if len(rest) == 0:
+                return view
+            return view.read(view.frames, rest)
+        if isinstance(frames, (int, np.integer)):
+            return self.read([self.frames[frames]], rest)[0]
+        frames = np.array(self.frames)[frames]
+        return self.read(frames, rest)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.read(self.frames)
+        if dtype != None:
+            values = values.astype(dtype, copy=False)
+        return values
+
+
+def codec_path(filepath):
+    """
+    Returns: str; path of the compressed run of the raw run at filepath
+    """
+    return os.path.splitext(filepath)[0] + CODEC_EXT
+
+
+def encode_run(filepath, resolution, out_path=None, chunk=DEFAULT_CHUNK, \
+    compressor="zlib", level=1, verify=True):
+    """
+    Losslessly compresses the raw run at filepath. Every byte of the raw file
+    is kept, including the metadata frame, the metadata pixels of each frame
+    and any trailing partial frame, so decode_run restores it exactly.
+
+    Args:
+        filepath: str, path to the raw run
+
+        resolution: array-like, resolution of the sensor
+
+        out_path: str, path of the compressed run, None for codec_path
+
+        chunk: int, number of frames encoded together, frames are read one
+            chunk at a time
+
+        compressor: str, "zlib" or "lzma"
+
+        level: int, compression level, low levels decode just as fast and
+            encode much faster
+
+        verify: bool, if True then each chunk is decoded again and compared
+            with the raw frames
+
+    Returns: str; out_path if the run was compressed, None otherwise
+    """
+    if compressor not in COMPRESSORS:
+        print("Error: unknown compressor \"{}\", use one of {}"\
+            .format(compressor, list(COMPRESSORS)))
+        return None
+    compress, decompress = COMPRESSORS[compressor]
+    if out_path == None:
+        out_path = codec_path(filepath)
+    pix_per_frame = resolution[0]*resolution[1] + 2
+    item = np.dtype(np.uint16).itemsize
+    size = os.path.getsize(filepath)
+    n_frames = size // (pix_per_frame*item)
+    if n_frames < 1:
+        print("Error: \"{}\" does not hold a whole frame".format(filepath))
+        return None
+    raw = np.memmap(filepath, dtype=np.uint16, mode="r", \
+        shape=(n_frames, pix_per_frame))
+    n_chunks = -(-(n_frames - 1) // chunk)
+    meta = {"version": CODEC_VERSION, "resolution": list(resolution), \
+        "n_frames": n_frames, "n_chunks": n_chunks, "chunk": chunk, \
+        "compressor": compressor}
+    header = json.dumps(meta).encode()
+    index = []
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.array([len(header)], dtype="<u4").tobytes())
+        f.write(header)
+
+        def write_blob(data):
+            blob = compress(data, level)
+            index.append((f.tell(), len(blob)))
+            f.write(blob)
+            return blob
+
+        write_blob(np.asarray(raw[0]).tobytes())
+        for i in range(1, n_frames, chunk):
+            frames = np.asarray(raw[i:i + chunk])
+            blob = write_blob(encode_chunk(frames))
+            if verify == True and not np.array_equal(\
+                decode_chunk(decompress(blob), len(frames)), frames):
+                print("Error: chunk at frame {} of \"{}\" did not decode "\
+                    "losslessly, aborting!".format(i, filepath))
+                f.close()
+                os.remove(tmp_path)
+                return None
+        with open(filepath, "rb") as raw_file:
+            raw_file.seek(n_frames*pix_per_frame*item)
+            write_blob(raw_file.read())
+        index_offset = f.tell()
+        f.write(np.array(index, dtype="<u8").tobytes())
+        f.write(np.array([index_offset], dtype="<u8").tobytes())
+    del raw
+    os.replace(tmp_path, out_path)
+    print("Compressed \"{}\" to {:.1f}% of its size".format(filepath, \
+        100*os.path.getsize(out_path)/size))
+    return out_path
+
+
+def decode_run(filepath, out_path):
+    """
+    Restores the raw run compressed in the file at filepath to out_path
+    """
+    run = CompressedRun(filepath)
+    with open(out_path + ".tmp", "wb") as f:
+        f.write(run.read_blob(0))
+        for i in range(run.meta["n_chunks"]):
+            f.write(run.read_chunk(i).tobytes())
+        f.write(run.read_blob(run.meta["n_chunks"] + 1))
+    os.replace(out_path + ".tmp", out_path)
@@ -1,9 +1,21 @@
 import sys
 import os
+import re
+import functools
+import time
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+import stats_cache as sc
+import run_codec as rc
+
 ETS = "Press <enter> to skip"
+DEFAULT_RUN_MEMORY = 8*2**30
 
 
 class Prog_data():
@@ -30,6 +42,12 @@ class Prog_data():
                 print("Run name: {}".format(key))
                 print("Number of datasets in run: {}".format(len(\
                 self.saved_runs[key])))
+                runs = self.saved_runs[key]
+                if isinstance(runs, Run):
+                    runs = [runs]
+                resident = sum(Run.registry.resident_bytes(run) \
+                    for run in runs)
+                print("Resident memory: {:.1f} MiB".format(resident/2**20))
         print("\n")
 
     def print_saved_ptc(self):
@@ -186,7 +204,11 @@ class Prog_data():
             run_name: str; name of run to delete   
         """
         if run_name in self.saved_runs.keys():
-            self.saved_runs.pop(run_name)
+            runs = self.saved_runs.pop(run_name)
+            if isinstance(runs, Run):
+                runs = [runs]
+            for run in runs:
+                Run.registry.forget(run)
         else:
             print("Error: did not find run \"{}\", aborting".format(run_name))
 
@@ -204,8 +226,139 @@ class Prog_data():
             print("Error: did not find PT curve \"{}\", aborting"\
                 .format(ptc_name)) 
 
+class RunRegistry():
+    """
+    Keeps the frame arrays of the loaded runs within a memory budget. Runs
+    report each access to their frame array, and once the frame arrays held
+    in memory exceed max_bytes the least recently used are evicted. Runs that
+    can be reloaded from their file are dropped and reloaded on their next
+    access, any other frame array is spilled to a memory mapped file in
+    spill_dir. Runs are only held weakly, and a spill file is deleted once
+    its run is forgotten, given new frames or garbage collected, or at exit.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_RUN_MEMORY, spill_dir=None):
+        """
+        Args:
+            max_bytes: int, memory the resident frame arrays are kept below
+
+            spill_dir: str, directory of spilled frame arrays, None for the
+                system temporary directory
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.runs = OrderedDict()
+        self.spills = {}
+        self.lock = threading.RLock()
+
+    def resident_bytes(self, run):
+        """
+        Returns: int; bytes of the frame array of run held in memory, memory
+            mapped and lazily decoded frame arrays take none
+        """
+        arr = run.__dict__.get("_frame_arr")
+        if not isinstance(arr, np.ndarray):
+            return 0
+        base = arr
+        while base is not None:
+            if isinstance(base, np.memmap):
+                return 0
+            base = getattr(base, "base", None)
+        return arr.nbytes
+
+    def touch(self, run):
+        """
+        Marks run as the most recently used run and evicts other runs if the
+        budget is exceeded. Runs holding no memory are not tracked
+        """
+        with self.lock:
+            if self.resident_bytes(run) == 0:
+                self.runs.pop(id(run), None)
+                return
+            self.runs[id(run)] = weakref.ref(run)
+            self.runs.move_to_end(id(run))
+            self.enforce(keep=run)
+
+    def resize(self, max_bytes):
+        """
+        Changes the memory budget, evicting runs if it is exceeded
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.enforce()
+
+    def enforce(self, keep=None):
+        """
+        Evicts the least recently used runs other than keep until the budget
+        is met
+        """
+        runs = []
+        for key, ref in list(self.runs.items()):
+            run = ref()
+            if run is None:
+                del self.runs[key]
+            else:
+                runs.append(run)
+        total = sum(self.resident_bytes(run) for run in runs)
+        for run in runs:
+            if total <= self.max_bytes or run is keep:
+                break
+            total -= self.resident_bytes(run)
+            self.evict(run)
+
+    def evict(self, run):
+        """
+        Removes the frame array of run from memory, dropping it if it can be
+        reloaded and spilling it to a memory mapped file otherwise
+        """
+        with self.lock:
+            self.runs.pop(id(run), None)
+            if self.resident_bytes(run) == 0:
+                return
+            if run.loader != None:
+                print("Dropped frames of run \"{}\" from memory"\
+                    .format(run.name))
+                run.__dict__["_frame_arr"] = None
+                return
+            spill_dir = self.spill_dir
+            if spill_dir == None:
+                spill_dir = tempfile.gettempdir()
+            os.makedirs(spill_dir, exist_ok=True)
+            fd, path = tempfile.mkstemp(suffix=".npy", dir=spill_dir)
+            os.close(fd)
+            # Removes the file once the run is gone, or at exit
+            self.spills[id(run)] = weakref.finalize(run, remove_spill, path)
+            np.save(path, run.__dict__["_frame_arr"])
+            run.__dict__["_frame_arr"] = np.load(path, mmap_mode="r")
+            print("Spilled frames of run \"{}\" to \"{}\"".format(run.name, \
+                path))
+
+    def forget(self, run):
+        """
+        Stops tracking run and deletes its spill file, e.g. once it has been
+        deleted or given new frames
+        """
+        with self.lock:
+            self.runs.pop(id(run), None)
+            spill = self.spills.pop(id(run), None)
+            if spill != None:
+                spill()
+
+
+def remove_spill(path):
+    """
+    Deletes a spill file of RunRegistry, the memory map of a run still
+    using it stays valid on posix systems
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 class Run():
     resolution = (520, 520) 
+    registry = RunRegistry()
 
     def __init__(self, success, name):
         """
@@ -217,38 +370,82 @@ class Run():
             Instance of the Run object with additional arguments:
                 filepath: str, path to run data
                 n_frames: int, the number of frames in the specific run
-                start_frame: first useful frame of the run
+                start_frame: first useful frame of frame_arr, this is 0 once
+                    the frame window has been applied by the reader
+                frame_window: tuple, (start_frame, end_frame, step) of the
+                    frames read from filepath
                 run_avg: float, average output for all pixels across all frames 
-                frame_arr: uint16 np.ndarray, pixel array for all frames
+                frame_arr: uint16 np.ndarray, pixel array for all frames,
+                    loaded by loader on first access and kept within the
+                    memory budget of Run.registry
+                loader: function, called without arguments to load
+                    frame_arr, None if frame_arr is set directly
                 frame_avg: np.ndarray, array of the individual average pixels output  
                 offset: np.ndarray, pixel array of offset (pedestal) values for the sensor
                 err_dark: np.ndarray, pixel array of dark (read) noise   
+                stats: RunStats, cached per-pixel statistics of the run, see
+                    get_run_stats
+                identity: dict, identity of the raw run the frames were
+                    made from (see stats_cache.file_identity) if it is not
+                    filepath, e.g. for a pixel store, None otherwise
         """
         self.success = success
         self.name = name
         self.filepath = None
         self.n_frames = None
         self.start_frame = None
+        self.frame_window = None
         self.run_avg = None
-        self.frame_arr = None
+        self._frame_arr = None
+        self.loader = None
         self.frame_avg = None
         self.offset = None
         self.err_dark = None
         self.use_pix = None
+        self.stats = None
+        self.identity = None
 
     def __len__(self):
             return 1
 
+    @property
+    def frame_arr(self):
+        if self._frame_arr is None and self.loader != None:
+            self._frame_arr = self.loader()
+        if self._frame_arr is not None:
+            self.registry.touch(self)
+        return self._frame_arr
+
+    @frame_arr.setter
+    def frame_arr(self, arr):
+        # Frames replaced by new ones no longer need their spill file
+        self.registry.forget(self)
+        self._frame_arr = arr
+        if arr is not None:
+            self.registry.touch(self)
 
-def file_t_arr(filepath, resolution, VERBOSE=False):
+
+def file_t_arr(filepath, resolution, VERBOSE=False, mmap=False, \
+    start_frame=0, end_frame=None, step=1):
     """
-    Extracts data from file into an numpy.ndarray. Removes metadata pixels
+    Extracts data from file into an numpy.ndarray. Removes metadata pixels.
+    Only the frames in [start_frame, end_frame) are read, the file is seeked
+    to the first wanted frame rather than read from the start. Compressed
+    runs (see run_codec) are decoded transparently.
     
     Args:
         filepath: str, path to the imput file containing the sensor data
         resolution: array-like, resolution of the sensor
         VERBOSE: bool, if set to True then the number of frames and the 
             output array will be printed to std output
+        mmap: bool, if set to True the file is memory mapped with map_file
+            instead of being read into memory, compressed runs are then
+            decoded lazily as frames are accessed
+        start_frame: int, first frame to read, counted after the metadata
+            frame
+        end_frame: int, frame to stop reading at (exclusive), if None then
+            all frames up to the end of the file are read
+        step: int, only every step-th frame in the window is read
 
     Returns:
     A [n_frame, n_pixels] numpy.ndarray 
@@ -257,71 +454,340 @@ def file_t_arr(filepath, resolution, VERBOSE=False):
     if len(resolution) != 2:
         print("Error: invalid resolution, check resolution in Run class.")
         return None
-    im = np.fromfile(filepath, dtype="uint16")
+    if mmap == True or step != 1 or rc.is_compressed(filepath):
+        mapped = map_file(filepath, resolution, start_frame=start_frame, \
+            end_frame=end_frame, step=step)
+        if mapped == None:
+            return None
+        im, n_frames = mapped
+        if mmap == False:
+            # Strided windows are gathered from the map, only touching the
+            # pages of the frames that are kept
+            im = np.ascontiguousarray(im)
+        if VERBOSE == True:
+            print("number of frames = {}".format(n_frames))
+            print(im)
+        return im, n_frames
     pix_per_frame = resolution[0]*resolution[1] + 2
+    window = get_frame_window(filepath, resolution, start_frame, end_frame)
+    if window == None:
+        return None
+    first, n_frames = window
+    # Seek past the metadata frame and the frames before the window
+    offset = (first + 1)*pix_per_frame*np.dtype("uint16").itemsize
+    im = np.fromfile(filepath, dtype="uint16", count=n_frames*pix_per_frame, \
+        offset=offset)
     # Reshapes into 2d array so the pixels are sorted into frames
-    n_frames = int(im.size / pix_per_frame)
     im = im.reshape([n_frames, pix_per_frame])
-    # Removes metdata in frame 0 and pixels 0, 1 in each subsequent frame
-    im = im[1:, 2:]
-    im = im.reshape([n_frames - 1, 520, 520])
+    # Removes metadata pixels 0, 1 in each frame
+    im = im[:, 2:]
+    im = im.reshape([n_frames, *resolution])
     if VERBOSE == True:
         print("number of frames = {}".format(n_frames))
         print(im)
-    return im, n_frames - 1
+    return im, n_frames
+
+
+def get_frame_window(filepath, resolution, start_frame=0, end_frame=None):
+    """
+    Determines which frames of the file at filepath lie in the window
+    [start_frame, end_frame)
+
+    Args:
+        filepath: str, path to the imput file containing the sensor data
+        resolution: array-like, resolution of the sensor
+        start_frame: int, first frame of the window
+        end_frame: int, frame the window stops at (exclusive), None for the
+            end of the file
+
+    Returns: tuple of the first frame and the number of frames in the window,
+        or None if the window is empty
+    """
+    if rc.is_compressed(filepath):
+        total = rc.CompressedRun(filepath).meta["n_frames"] - 1
+    else:
+        pix_per_frame = resolution[0]*resolution[1] + 2
+        file_pix = os.path.getsize(filepath) // np.dtype("uint16").itemsize
+        # The first frame only holds metadata
+        total = file_pix // pix_per_frame - 1
+    first, last, _ = slice(start_frame, end_frame).indices(max(total, 0))
+    if last <= first:
+        print("Error: no frames in window [{}, {}) of \"{}\" ({} frames)"\
+            .format(start_frame, end_frame, filepath, total))
+        return None
+    return first, last - first
+
 
-def get_single_run(name, filepath, start_frame):
+def map_file(filepath, resolution, start_frame=0, end_frame=None, step=1):
     """
-    Extracts the frame data from filepath file into an array, removes any 
-    metadata and returns and instance of the Run object
+    Memory maps the data in filepath as a read only [n_frames, *resolution]
+    strided view. The metadata frame and the two metadata pixels at the start
+    of each frame are skipped by the strides, so no data is copied and only
+    the pages that are accessed are read from disk. Compressed runs are
+    returned as a run_codec.CompressedRun view instead, which decodes the
+    chunks of frames as they are accessed.
+
+    Args:
+        filepath: str, path to the imput file containing the sensor data
+        resolution: array-like, resolution of the sensor
+        start_frame: int, first frame of the view
+        end_frame: int, frame the view stops at (exclusive), None for the end
+            of the file
+        step: int, stride between frames in the view
+
+    Returns: tuple of the read only view and the number of frames in it
+    """
+    if step < 1:
+        print("Error: frame step must be at least 1, not {}".format(step))
+        return None
+    window = get_frame_window(filepath, resolution, start_frame, end_frame)
+    if window == None:
+        return None
+    first, n_frames = window
+    if rc.is_compressed(filepath):
+        im = rc.CompressedRun(filepath)[first:first + n_frames:step]
+        return im, len(im)
+    n_frames = -(-n_frames // step)
+    pix_per_frame = resolution[0]*resolution[1] + 2
+    item = np.dtype("uint16").itemsize
+    # Map from pixel 2 of the first wanted frame, frame 0 is metadata
+    offset = ((first + 1)*pix_per_frame + 2)*item
+    shape = ((n_frames - 1)*step*pix_per_frame + resolution[0]*resolution[1],)
+    raw = np.memmap(filepath, dtype="uint16", mode="r", offset=offset, \
+        shape=shape)
+    im = np.lib.stride_tricks.as_strided(raw,
+        shape=(n_frames, *resolution),
+        strides=(step*pix_per_frame*item, resolution[1]*item, item),
+        writeable=False)
+    return im, n_frames
+
+
+def get_single_run(name, filepath, start_frame, end_frame=None, step=1, \
+    mmap=True, cache_dir=None):
+    """
+    Creates a Run object for the frame data in filepath, the frames are only
+    read (and the metadata removed) when run.frame_arr is first accessed.
+    Only the frames in [start_frame, end_frame) are read.
 
     Args:
         name: str; name of the dataset
+
+        start_frame: int; first useful frame in the run
+
+        end_frame: int; frame to stop at (exclusive), None for all frames
+
+        step: int; only every step-th frame is read, for quick-look decimation
+
+        mmap: bool; if set to True the frame data is memory mapped rather
+            than read into memory, see map_file
+
+        cache_dir: str; directory of the statistics sidecars, None for next
+            to the run. If a valid sidecar exists run.stats and
+            run.frame_avg are loaded from it
     returns: Run object with corresponding name, filepath, and frame_avg.
     """
     run = Run(True, name)
     run.filepath = filepath
-    run.frame_arr, run.n_frames = file_t_arr(run.filepath, run.resolution)
-    run.start_frame = start_frame
+    window = get_frame_window(filepath, run.resolution, start_frame, end_frame)
+    if window == None:
+        run.success = False
+        return run
+    run.n_frames = -(-window[1] // step)
+    # The frames are only read when frame_arr is first used
+    resolution = run.resolution
+    # A partial rather than a closure so the run can be pickled
+    run.loader = functools.partial(load_frames, filepath, resolution, \
+        start_frame, end_frame, step, mmap)
+    # Frames before start_frame were never read
+    run.start_frame = 0
+    run.frame_window = (start_frame, end_frame, step)
+    run.stats = sc.load_run_stats(filepath, run.frame_window, cache_dir)
+    if run.stats != None:
+        run.frame_avg = run.stats.frame_mean
     return run
 
 
-def get_multi_run(dirpath, start_frame):
+def load_frames(filepath, resolution, start_frame, end_frame, step, mmap):
+    """
+    Loader of the runs made by get_single_run
+
+    Returns: [n_frames, *resolution] array of the frames of the run
+    """
+    return file_t_arr(filepath, resolution, mmap=mmap, \
+        start_frame=start_frame, end_frame=end_frame, step=step)[0]
+
+
+def get_run_stats(run, cache_dir=None, chunk=sc.CHUNK):
     """
-    Asks user for an indentifier and tried to match it to a filename in the
-    directory at the end of dirpath. If a valid filename is found 
-    it will try to create a list of multiple run objects using get_single_run.
+    Returns the per-pixel statistics of run, from its sidecar if it is valid
+    and otherwise by reading the run once and writing the sidecar
+
+    Args:
+        run: Run class instance
+
+        cache_dir: str; directory of the statistics sidecars, None for next
+            to the run
+
+        chunk: int; number of frames read at a time
+
+    Returns: RunStats class instance, also stored in run.stats
+    """
+    if run.stats != None:
+        return run.stats
+    window = run.frame_window
+    if window == None:
+        window = (run.start_frame, None, 1)
+    if run.filepath != None:
+        run.stats = sc.load_run_stats(run.filepath, window, cache_dir)
+    if run.stats == None:
+        run.stats = sc.compute_run_stats(run.frame_arr[run.start_frame:], \
+            window, chunk=chunk)
+        if run.filepath != None:
+            sc.save_run_stats(run.stats, run.filepath, cache_dir)
+    run.frame_avg = run.stats.frame_mean
+    return run.stats
+
+
+def get_file_stats(filepath, resolution, start_frame=0, end_frame=None, \
+    step=1, cache_dir=None, chunk=sc.CHUNK):
+    """
+    Returns the per-pixel statistics of the frames in [start_frame,
+    end_frame) of the raw run at filepath, from its sidecar if it is valid and
+    otherwise by reading the run once and writing the sidecar
+
+    Returns: RunStats class instance
+    """
+    window = (start_frame, end_frame, step)
+    stats = sc.load_run_stats(filepath, window, cache_dir)
+    if stats == None:
+        im, _ = map_file(filepath, resolution, start_frame=start_frame, \
+            end_frame=end_frame, step=step)
+        stats = sc.compute_run_stats(im, window, chunk=chunk)
+        sc.save_run_stats(stats, filepath, cache_dir)
+    return stats
+
+
+def natural_key(filepath):
+    """
+    Sort key of a run filename that orders the numbers in it by value, e.g.
+    exposure or illumination level, so "run_2" comes before "run_10"
+
+    Returns: list of the text and number parts of the filename
+    """
+    parts = re.split(r"(\d+(?:\.\d+)?)", os.path.basename(filepath))
+    return [float(part) if i % 2 == 1 else part.lower() \
+        for i, part in enumerate(parts)]
+
+
+def find_run_files(dirpath, run_id=""):
+    """
+    Finds the raw and compressed run files in dirpath whose filenames
+    contain run_id. A run that is there both raw and compressed is only
+    returned once, as the raw file
+
+    Args:
+        dirpath: raw str; valid path to directory
+
+        run_id: str; identifier that must be part of the filename
+
+    Returns: list of the paths to the matching raw files in natural order,
+        see natural_key
+    """
+    filepaths = {}
+    for filename in os.listdir(dirpath):
+        stem, ext = os.path.splitext(filename)
+        if ext not in (".raw", rc.CODEC_EXT) or run_id not in filename:
+            continue
+        if ext == ".raw" or stem not in filepaths:
+            filepaths[stem] = os.path.join(dirpath, filename)
+    return sorted(filepaths.values(), key=natural_key)
+
+
+def get_multi_run(dirpath, start_frame, end_frame=None, step=1, run_id=None, \
+    load=False, reduce=False, workers=None, cache_dir=None):
+    """
+    Creates a list of Run objects from the raw runs in dirpath whose
+    filenames contain an identifier. The runs are ordered by the numbers in
+    their filenames (see natural_key) and opened concurrently on a thread
+    pool, numpy releases the GIL while reading so the files are read in
+    parallel. The throughput of each file is printed.
 
     Args:
         dirpath: raw str; valid path to directory
 
         start_frame: int; first useful frame in each run object
 
+        end_frame: int; frame to stop at in each run object (exclusive)
+
+        step: int; only every step-th frame is read
+
+        run_id: str; identifier that filenames of the runs must contain, if
+            None the user is asked for it
+
+        load: bool; if True then the frames of each run are read into memory
+            now rather than on first access
+
+        reduce: bool; if True then the statistics of each run are calculated
+            (or loaded from their sidecars) now, see get_run_stats
+
+        workers: int; number of files opened at once, None for the thread
+            pool default
+
+        cache_dir: str; directory of the statistics sidecars, None for next
+            to each run
+
     Returns: list of Run objects where the name corresponds to the filename
-    for the file containing the data 
+    for the file containing the data, files without frames in the window
+    are skipped
     """
-    dir_filenames = os.listdir(dirpath)
-    if len(dir_filenames) == 0:
-        print("Error: directory \"{}\" is empty, aborting!"\
+    if len(find_run_files(dirpath)) == 0:
+        print("Error: directory \"{}\" contains no runs, aborting!"\
             .format(dirpath))
         return
-    while True:
+    while run_id == None:
         print("Please input an identifier for filenames belonging to the run")
         run_id = input()
-        for filename in dir_filenames:
-            if run_id in filename:
-                run_id = True
-                break
-        if run_id == True:
-            break
-        else:
+        if len(find_run_files(dirpath, run_id)) == 0:
             print("Error: identifier \"{}\"did not match to any filenames, aborting"\
                 .format(run_id))
+            run_id = None
+    filepaths = find_run_files(dirpath, run_id)
+
+    def open_run(filepath):
+        begin = time.perf_counter()
+        run = get_single_run(name=os.path.basename(filepath), \
+            filepath=filepath, start_frame=start_frame, end_frame=end_frame, \
+            step=step, mmap=not load, cache_dir=cache_dir)
+        n_bytes = 0
+        if run.success == True:
+            if load == True:
+                n_bytes += run.frame_arr.nbytes
+            if reduce == True and run.stats == None:
+                get_run_stats(run, cache_dir=cache_dir)
+                n_bytes += run.n_frames*run.resolution[0]*run.resolution[1]\
+                    *np.dtype("uint16").itemsize
+        return run, n_bytes, time.perf_counter() - begin
+
+    begin = time.perf_counter()
     multi_run = []
-    for filename in dir_filenames:
-        filetype = filename.split(".")[-1]
-        if filetype == "raw":
-            filepath = os.path.join(dirpath, filename)
-            multi_run.append(get_single_run(name=filename,\
-                filepath=filepath, start_frame=start_frame))
-    return multi_run
\ No newline at end of file
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for run, n_bytes, seconds in pool.map(open_run, filepaths):
+            if run.success == False:
+                print("Warning: \"{}\" has no frames in the frame window, "\
+                    "skipping it".format(run.name))
+                continue
+            multi_run.append(run)
+            total_bytes += n_bytes
+            if n_bytes > 0:
+                print("Read \"{}\": {:.1f} MiB in {:.2f} s ({:.1f} MiB/s)"\
+                    .format(run.name, n_bytes/2**20, seconds, \
+                    n_bytes/2**20/max(seconds, 1e-9)))
+    seconds = time.perf_counter() - begin
+    print("Opened {} runs in {:.2f} s".format(len(multi_run), seconds), \
+        end="")
+    if total_bytes > 0:
+        print(", read {:.1f} MiB ({:.1f} MiB/s)".format(total_bytes/2**20, \
+            total_bytes/2**20/max(seconds, 1e-9)), end="")
+    print("")
+    return multi_run
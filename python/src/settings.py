@@ -2,6 +2,10 @@ import os
 import numpy as np
 from time import sleep
 
+import moment_tools as mt
+import product_cache as pc
+import run_path_tools as rpt
+
 ETS = "Press <enter> to skip"
 default_noise = "Dark_test1"
 default_offset = "w5_offset"
@@ -15,6 +19,11 @@ class Settings():
     Args:
         start_frame: int, the first frame of the run that is used for analysis
         end_frame: int, the final frame in the run that is used for analysis
+            (exclusive), None to use every frame after start_frame
+        frame_step: int, stride between the frames that are read, set above 1
+            for quick-look decimation
+        run_memory: int, bytes of frame data loaded runs may keep in memory
+            before the least recently used are evicted
     """
     def __init__(self, src_path, offset=default_offset, noise=default_noise, \
         chi2=default_chi2, passed_pix=default_passed_pix):
@@ -26,10 +35,28 @@ class Settings():
         self.resolution = (520, 520)
         self.start_frame = 20
         self.end_frame = None
+        self.frame_step = 1
         self.offset = None
         self.dark_noise = None
         self.chi2_vals = None
         self.passed_pix = None
+        self.cache = pc.ProductCache(self.get_cache_path())
+        rpt.Run.registry.spill_dir = self.get_spill_path()
+        self.run_memory = rpt.DEFAULT_RUN_MEMORY
+
+    @property
+    def run_memory(self):
+        return self._run_memory
+
+    @run_memory.setter
+    def run_memory(self, run_memory):
+        # The budget applies to every loaded run, not only new ones
+        self._run_memory = run_memory
+        try:
+            rpt.Run.registry.resize(int(run_memory))
+        except (TypeError, ValueError):
+            # Reported by check
+            pass
 
     def ask_save(self, parameter):
         """
@@ -54,6 +81,24 @@ class Settings():
         parent_dir = os.path.split(self.src_path)[0]
         return os.path.join(parent_dir, "lib", "Dark_Offset", offset_name)
         
+    def get_cache_path(self):
+        """
+        Creates the path of the derived product cache using src_path
+        
+        Returns: The full cache path
+        """
+        parent_dir = os.path.split(self.src_path)[0]
+        return os.path.join(parent_dir, "lib", "Cache")
+
+    def get_spill_path(self):
+        """
+        Creates the path of the spilled run frames using src_path
+        
+        Returns: The full spill path
+        """
+        parent_dir = os.path.split(self.src_path)[0]
+        return os.path.join(parent_dir, "lib", "Spill")
+
     def get_noise_path(self, noise_name):
         """
         Creates the dark (read) noise filepath using src_path and default_noise
@@ -131,6 +176,65 @@ class Settings():
 
 
 
+    def calc_dark(self, filepaths, chunk=mt.DEFAULT_CHUNK):
+        """
+        Calculates the offset and dark (read) noise from one or more dark runs
+        with get_dark and saves them to self.offset and self.dark_noise.
+
+        Args:
+            filepaths: array-like, paths to the raw dark runs
+
+            chunk: int, number of frames read at a time
+        """
+        dark = self.get_dark(filepaths, chunk=chunk)
+        self.offset = dark[0]
+        self.dark_noise = dark[1]
+
+    def get_dark(self, filepaths, chunk=mt.DEFAULT_CHUNK):
+        """
+        Calculates the offset and dark (read) noise from one or more runs in a
+        single chunked pass over each file, merging the moments of all files.
+        Runs with a valid statistics sidecar are not read and maps already
+        made from the same runs, e.g. by pipeline.characterise, are taken from
+        self.cache. The settings are not changed.
+
+        Args:
+            filepaths: array-like, paths to the raw runs
+
+            chunk: int, number of frames read at a time
+
+        Returns: [2, *resolution] array of the offset (dim 0) and noise
+            (dim 1)
+        """
+        def compute():
+            moments = mt.merge_moments([mt.stats_moments(rpt.get_file_stats(\
+                filepath, self.resolution, start_frame=self.start_frame, \
+                end_frame=self.end_frame, step=self.frame_step, chunk=chunk)) \
+                for filepath in filepaths])
+            return np.stack([moments.mean, moments.std()])
+        return pc.cached_array(self.cache, "dark", filepaths, \
+            {"start_frame": self.start_frame, "end_frame": self.end_frame, \
+            "frame_step": self.frame_step}, compute)
+
+    def run_dark(self, run):
+        """
+        Calculates the mean and noise of run with get_dark if it was read
+        from a raw file with the frame window of these settings, so the maps
+        are shared through self.cache with pipeline.characterise. The
+        settings are not changed.
+
+        Args:
+            run: Run class instance
+
+        Returns: [2, *resolution] array of the mean (dim 0) and noise (dim 1),
+            None if run has to be reduced directly
+        """
+        window = (self.start_frame, self.end_frame, self.frame_step)
+        if not isinstance(run, rpt.Run) or run.filepath == None \
+            or run.identity != None or run.frame_window != window:
+            return None
+        return self.get_dark([run.filepath])
+
     def get_offset(self):
         """
         Reads pedestal values from filepath and updates Settings.pedestal
@@ -249,6 +353,20 @@ class Settings():
             issue_setting = "end_frame"
             issue_type = type(self.end_frame)
             default_type = "<int>"
+
+        try:
+            int(self.frame_step)
+        except:
+            issue_setting = "frame_step"
+            issue_type = type(self.frame_step)
+            default_type = "<int>"
+
+        try:
+            int(self.run_memory)
+        except:
+            issue_setting = "run_memory"
+            issue_type = type(self.run_memory)
+            default_type = "<int>"
         
         if issue_setting != None:
             print("Settings error: {} must be type {}, not {}".format(issue_setting, default_type, issue_type))
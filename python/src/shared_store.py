@@ -0,0 +1,275 @@
+import weakref
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import pixel_store as ps
+import run_codec as rc
+import run_path_tools as rpt
+
+
+def pool_context():
+    """
+    Returns the multiprocessing context process pools are started with.
+    Forking while other threads run, e.g. from a stage of
+    pipeline.run_stages, can leave the child waiting on a lock held by a
+    thread that was not copied, so then the forkserver (or spawn) start
+    method is used.
+
+    Returns: multiprocessing context, None for the default when this is the
+        only thread
+    """
+    if threading.active_count() == 1:
+        return None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def find_memmap(arr):
+    """
+    Finds the np.memmap that arr is a view of, e.g. a run opened with
+    run_path_tools.map_file
+
+    Returns: np.memmap, or None if arr is not backed by a file
+    """
+    base = arr
+    while base is not None:
+        if isinstance(base, np.memmap) and base.filename != None:
+            return base
+        base = getattr(base, "base", None)
+    return None
+
+
+def share_array(arr):
+    """
+    Makes arr available to other processes without pickling it. Views of a
+    memory mapped file are shared by their file, offset and strides, any
+    other array is copied once into a shared memory segment. Pixel stores
+    and compressed runs are shared by their path and arrays that have already
+    been published by their SharedArray handle.
+
+    Args:
+        arr: np.ndarray, pixel_store.PixelStore, run_codec.CompressedRun or
+            SharedArray, array to share
+
+    Returns: tuple of the handle to pass to attach_array and the
+        SharedMemory segment (None for memory mapped files), which must be
+        closed and unlinked by the caller once the workers are done
+    """
+    if isinstance(arr, SharedArray):
+        # The publisher owns the segment
+        return arr.handle, None
+    if isinstance(arr, (ps.PixelStore, rc.CompressedRun)):
+        return arr.share_handle(), None
+    mapped = find_memmap(arr)
+    if mapped is not None:
+        address = arr.__array_interface__["data"][0]
+        map_address = mapped.__array_interface__["data"][0]
+        offset = mapped.offset + address - map_address
+        size = offset + (np.array(arr.shape) - 1).dot(arr.strides) \
+            + arr.itemsize
+        handle = ("mmap", mapped.filename, offset, int(size - offset), \
+            arr.shape, arr.strides, arr.dtype.str)
+        return handle, None
+    segment = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=segment.buf)
+    shared[...] = arr
+    handle = ("shm", segment.name, arr.shape, arr.dtype.str)
+    return handle, segment
+
+
+def attach_array(handle):
+    """
+    Attaches to an array shared with share_array
+
+    Args:
+        handle: tuple, handle returned by share_array
+
+    Returns: tuple of the array and the SharedMemory segment (None for memory
+        mapped files) that must be kept open while the array is used
+    """
+    if handle[0] == "mmap":
+        _, filename, offset, size, shape, strides, dtype = handle
+        raw = np.memmap(filename, dtype=np.uint8, mode="r", offset=offset, \
+            shape=(size,))
+        arr = np.lib.stride_tricks.as_strided(raw.view(dtype), shape=shape, \
+            strides=strides, writeable=False)
+        return arr, None
+    if handle[0] == "store":
+        _, dirpath, start, stop, step = handle
+        return ps.PixelStore(dirpath, frames=range(start, stop, step)), None
+    if handle[0] == "rawz":
+        _, filepath, start, stop, step = handle
+        return rc.CompressedRun(filepath, frames=range(start, stop, step)), \
+            None
+    _, name, shape, dtype = handle
+    segment = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    return arr, segment
+
+
+def release_segment(segment):
+    """
+    Closes and unlinks a shared memory segment, segments that are already
+    gone are ignored
+    """
+    if segment is None:
+        return
+    segment.close()
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class SharedArray():
+    """
+    Array published once for use by other processes. Pickling a SharedArray
+    only sends its handle, so it can be passed to any number of workers which
+    attach to the same copy of the data with array(). The publisher's
+    segment is unlinked by close(), when leaving a with block, when the
+    SharedArray is garbage collected or at the latest when the program exits.
+    """
+
+    def __init__(self, arr):
+        """
+        Args:
+            arr: array-like, array to publish, see share_array
+        """
+        self.handle, self.segment = share_array(arr)
+        self.shape = tuple(arr.shape)
+        self.dtype = np.dtype(arr.dtype)
+        self.attached = None
+        self.finalizer = weakref.finalize(self, release_segment, self.segment)
+
+    def __getstate__(self):
+        return {"handle": self.handle, "shape": self.shape, \
+            "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.segment = None
+        self.attached = None
+        self.finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def array(self):
+        """
+        Returns: the published array, attached without copying
+        """
+        if self.attached == None:
+            self.attached = attach_array(self.handle)
+        return self.attached[0]
+
+    def close(self):
+        """
+        Releases the attachment of this process and, in the publishing
+        process, unlinks the segment
+        """
+        if self.attached != None:
+            arr, segment = self.attached
+            self.attached = None
+            del arr
+            if segment is not None:
+                segment.close()
+        if self.finalizer != None:
+            self.finalizer()
+
+
+class SharedRun():
+    """
+    Run whose frames have been published once with SharedArray. It pickles to
+    a few small attributes and the name of its frames, so it can be sent to
+    worker processes which recreate the Run with attach().
+    """
+
+    def __init__(self, run):
+        """
+        Args:
+            run: Run class instance, only its frames from run.start_frame on
+                are published
+        """
+        self.name = run.name
+        self.filepath = run.filepath
+        self.start_frame = 0
+        self.frame_window = run.frame_window
+        self.resolution = run.resolution
+        self.offset = run.offset
+        self.err_dark = run.err_dark
+        self.stats = run.stats
+        self.identity = run.identity
+        self.frames = SharedArray(run.frame_arr[run.start_frame:])
+        self.n_frames = len(self.frames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return 1
+
+    def attach(self):
+        """
+        Returns: Run object whose frame_arr is the published frames
+        """
+        run = rpt.Run(True, self.name)
+        run.filepath = self.filepath
+        run.n_frames = self.n_frames
+        run.start_frame = 0
+        run.frame_window = self.frame_window
+        run.resolution = self.resolution
+        run.offset = self.offset
+        run.err_dark = self.err_dark
+        run.stats = self.stats
+        run.identity = self.identity
+        # Evicting the run only drops the attachment
+        run.loader = self.frames.array
+        return run
+
+    def close(self):
+        """
+        Unlinks the published frames, see SharedArray.close
+        """
+        self.frames.close()
+
+
+def publish_run(run):
+    """
+    Publishes the frames of run for worker processes
+
+    Returns: SharedRun class instance, close it (or use it in a with block)
+        once the workers are done
+    """
+    return SharedRun(run)
+
+
+def as_run(run):
+    """
+    Returns: Run object for run, attaching it if it is a SharedRun
+    """
+    if isinstance(run, SharedRun):
+        return run.attach()
+    return run
+
+
+def run_frames(run):
+    """
+    Returns: the frames of run from run.start_frame on, for a SharedRun the
+        SharedArray so that tile workers attach to it rather than copying it
+    """
+    if isinstance(run, SharedRun):
+        return run.frames
+    return run.frame_arr[run.start_frame:]
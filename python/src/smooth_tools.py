@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def moving_average(arr, smooth, axis=0):
+    """
+    Smooths arr with a moving average over 2*smooth + 1 points along axis.
+    Points beyond the ends of the axis are clamped to the first and last
+    values, so the output has the same shape as arr.
+
+    Args:
+        arr: array-like, array to smooth, e.g. a stacked PTC array
+
+        smooth: int, number of points either side of each point in the
+            average
+
+        axis: int, axis to smooth along
+
+    Returns: np.ndarray of the smoothed values
+    """
+    arr = np.asarray(arr, dtype=np.float64)
+    if smooth == None or smooth < 1:
+        return arr.copy()
+    arr = np.moveaxis(arr, axis, 0)
+    n_points = arr.shape[0]
+    width = 2*smooth + 1
+    # Clamp the edges then take differences of the cumulative sum
+    padded = np.concatenate([np.repeat(arr[:1], smooth, axis=0), arr, \
+        np.repeat(arr[-1:], smooth, axis=0)])
+    cumsum = np.zeros([n_points + width, *arr.shape[1:]], dtype=np.float64)
+    np.cumsum(padded, axis=0, out=cumsum[1:])
+    smoothed = (cumsum[width:] - cumsum[:-width]) / width
+    return np.moveaxis(smoothed, 0, axis)
+
+
+def find_peak(arr, smooth=3, axis=0):
+    """
+    Finds the index of the maximum of each pixel's smoothed curve along axis,
+    e.g. the full well peak of every pixel's PT curve
+
+    Args:
+        arr: array-like, stacked array such as PTC.err_tot
+
+        smooth: int, number of points either side of each point in the
+            moving average
+
+        axis: int, axis of the curve, e.g. the run axis
+
+    Returns: np.ndarray of the peak index of each pixel
+    """
+    return moving_average(arr, smooth, axis=axis).argmax(axis=axis)
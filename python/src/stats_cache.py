@@ -0,0 +1,261 @@
+import os
+import json
+import hashlib
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+CHUNK = 64
+HASH_BYTES = 1 << 20
+SIDECAR_EXT = ".stats.npz"
+SIDECAR_VERSION = 1
+# Largest frame count for which n*sumsq - sum**2 of uint16 frames fits uint64
+EXACT_FRAMES = 2**16
+
+
+class RunStats():
+    """
+    Per-pixel statistics of the frames of a run, stored in a sidecar file
+    next to the run so they only have to be calculated once
+    """
+
+    def __init__(self, resolution, window):
+        """
+        Class attributes:
+            n_frames: int, number of frames accumulated
+
+            sum: np.ndarray, uint64 pixel array of the sum over all frames
+
+            sumsq: np.ndarray, uint64 pixel array of the sum of squares
+
+            min: np.ndarray, pixel array of the smallest value of each pixel
+
+            max: np.ndarray, pixel array of the largest value of each pixel
+
+            frame_mean: np.ndarray, average of all pixels in each frame
+
+            window: tuple, (start_frame, end_frame, step) of the frames used
+
+            identity: dict, identity of the run file, see file_identity
+        """
+        self.n_frames = 0
+        self.sum = np.zeros(resolution, dtype=np.uint64)
+        self.sumsq = np.zeros(resolution, dtype=np.uint64)
+        self.min = np.full(resolution, np.iinfo(np.uint16).max, \
+            dtype=np.uint16)
+        self.max = np.zeros(resolution, dtype=np.uint16)
+        self.frame_mean = np.zeros(0, dtype=np.float64)
+        self.window = tuple(window)
+        self.identity = None
+
+    def mean(self):
+        """
+        Returns: pixel array of the mean of each pixel
+        """
+        return self.sum / self.n_frames
+
+    def var(self, ddof=0):
+        """
+        Returns: pixel array of the variance of each pixel with ddof delta
+            degrees of freedom. The numerator n*sumsq - sum**2 is formed
+            exactly in integers, so the result does not depend on how the
+            frames were chunked.
+        """
+        n = self.n_frames
+        if n < EXACT_FRAMES:
+            numerator = self.sumsq*np.uint64(n) - np.square(self.sum)
+            return numerator / (n*(n - ddof))
+        mean = self.mean()
+        return (self.sumsq - self.sum*mean) / (n - ddof)
+
+    def merge(self, other):
+        """
+        Adds the statistics of the frames in other, which follow the frames
+        of self, to self. The sums are integers so merging is exact.
+        """
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self.frame_mean = np.concatenate([self.frame_mean, other.frame_mean])
+        self.n_frames += other.n_frames
+
+
+def accumulate(stats, frames):
+    """
+    Adds a chunk of uint16 frames to stats. The chunk is summed a frame at a
+    time into uint32 (exact for up to 65537 frames) and the squares into
+    uint64, so no float or full chunk sized temporaries are made.
+
+    Args:
+        stats: RunStats class instance
+
+        frames: [n_frames, *resolution] uint16 np.ndarray
+    """
+    part = np.zeros(frames.shape[1:], dtype=np.uint32)
+    square = np.empty(frames.shape[1:], dtype=np.uint32)
+    frame_sum = np.zeros(len(frames), dtype=np.uint64)
+    for i, frame in enumerate(frames):
+        np.add(part, frame, out=part)
+        np.multiply(frame, frame, out=square, dtype=np.uint32)
+        np.add(stats.sumsq, square, out=stats.sumsq)
+        frame_sum[i] = frame.sum(dtype=np.uint64)
+    np.add(stats.sum, part, out=stats.sum)
+    np.minimum(stats.min, frames.min(axis=0), out=stats.min)
+    np.maximum(stats.max, frames.max(axis=0), out=stats.max)
+    n_pix = np.prod(frames.shape[1:])
+    stats.frame_mean = np.concatenate([stats.frame_mean, frame_sum / n_pix])
+    stats.n_frames += len(frames)
+
+
+def compute_run_stats(arr, window, chunk=CHUNK, workers=1):
+    """
+    Calculates the statistics of a uint16 frame array in one pass, reading
+    chunk frames at a time. The sums are exact integers, so the result is
+    the same whatever chunk and workers are.
+
+    Args:
+        arr: array-like, [n_frames, *resolution] frames, e.g. a memory mapped
+            run
+
+        window: tuple, (start_frame, end_frame, step) arr was read with
+
+        chunk: int, number of frames read at a time
+
+        workers: int, number of threads, each reduces its own share of the
+            frames
+
+    Returns: RunStats class instance
+    """
+    n_frames = arr.shape[0]
+
+    def reduce(first, last):
+        stats = RunStats(arr.shape[1:], window)
+        for i in range(first, last, chunk):
+            frames = np.asarray(arr[i:min(i + chunk, last)])
+            if frames.dtype.kind != "u" or frames.dtype.itemsize > 2:
+                frames = frames.astype(np.uint16)
+            accumulate(stats, frames)
+        return stats
+
+    bounds = np.linspace(0, n_frames, max(workers, 1) + 1).astype(int)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(reduce, bounds[:-1], bounds[1:]))
+    else:
+        parts = [reduce(0, n_frames)]
+    stats = parts[0]
+    for part in parts[1:]:
+        stats.merge(part)
+    return stats
+
+
+def file_identity(filepath):
+    """
+    Identifies the contents of a run file without reading all of it. The
+    content hash covers the size and the first and last HASH_BYTES of the
+    file, hashing the whole file would cost as much as reading the run.
+
+    Returns: dict of the absolute path, size, modification time and hash
+    """
+    size = os.path.getsize(filepath)
+    sha = hashlib.sha1(str(size).encode())
+    with open(filepath, "rb") as f:
+        sha.update(f.read(HASH_BYTES))
+        if size > HASH_BYTES:
+            f.seek(max(size - HASH_BYTES, HASH_BYTES))
+            sha.update(f.read(HASH_BYTES))
+    return {"path": os.path.abspath(filepath), "size": size, \
+        "mtime": os.path.getmtime(filepath), "hash": sha.hexdigest()}
+
+
+def sidecar_path(filepath, cache_dir=None):
+    """
+    Returns: str; path of the statistics sidecar of the run at filepath, next
+        to the run or in cache_dir if it is given
+    """
+    if cache_dir == None:
+        return filepath + SIDECAR_EXT
+    # Runs with the same filename in different directories must not clash
+    tag = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()[:8]
+    filename = "{}-{}{}".format(os.path.basename(filepath), tag, SIDECAR_EXT)
+    return os.path.join(cache_dir, filename)
+
+
+def load_run_stats(filepath, window, cache_dir=None):
+    """
+    Loads the statistics of the run at filepath from its sidecar
+
+    Args:
+        filepath: str, path to the raw run
+
+        window: tuple, (start_frame, end_frame, step) of the wanted frames
+
+        cache_dir: str, directory of the sidecar, None for next to the run
+
+    Returns: RunStats class instance, or None if there is no sidecar or it
+        was made from a different file or frame window
+    """
+    path = sidecar_path(filepath, cache_dir)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["version"] != SIDECAR_VERSION \
+                or tuple(meta["window"]) != tuple(window):
+                return None
+            # Cheap checks first, the hash reads from the run file
+            identity = meta["identity"]
+            if identity["size"] != os.path.getsize(filepath) \
+                or identity["mtime"] != os.path.getmtime(filepath) \
+                or identity != file_identity(filepath):
+                return None
+            stats = RunStats(data["sum"].shape, window)
+            stats.n_frames = meta["n_frames"]
+            stats.sum = data["sum"]
+            stats.sumsq = data["sumsq"]
+            stats.min = data["min"]
+            stats.max = data["max"]
+            stats.frame_mean = data["frame_mean"]
+            stats.identity = identity
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # e.g. a truncated sidecar, the statistics are calculated again
+        print("Warning: could not read statistics sidecar \"{}\"".format(path))
+        return None
+    return stats
+
+
+def save_run_stats(stats, filepath, cache_dir=None):
+    """
+    Saves stats to the sidecar of the run at filepath. Failing to write the
+    sidecar, e.g. to a read only directory, only prints a warning.
+
+    Returns: bool; True if the sidecar was written
+    """
+    path = sidecar_path(filepath, cache_dir)
+    stats.identity = file_identity(filepath)
+    meta = {"version": SIDECAR_VERSION, "window": list(stats.window), \
+        "n_frames": stats.n_frames, "identity": stats.identity}
+    tmp_path = None
+    try:
+        if cache_dir != None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # A temporary file of its own, processes may write the same sidecar
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp.npz", \
+            dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), sum=stats.sum, \
+                sumsq=stats.sumsq, min=stats.min, max=stats.max, \
+                frame_mean=stats.frame_mean)
+        # mkstemp files are private to the user
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError:
+        print("Warning: could not write statistics sidecar \"{}\"".format(path))
+        if tmp_path != None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
@@ -0,0 +1,171 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import shared_store as ss
+
+DEFAULT_TILE = (16, 520)
+
+
+def get_tiles(resolution, tile=DEFAULT_TILE):
+    """
+    Splits the sensor into tiles
+
+    Args:
+        resolution: array-like, resolution of the sensor
+
+        tile: array-like, (rows, columns) of each tile, tiles at the edge of
+            the sensor may be smaller
+
+    Returns: list of (row start, row end, column start, column end) tuples
+    """
+    tiles = []
+    for i in range(0, resolution[0], tile[0]):
+        for j in range(0, resolution[1], tile[1]):
+            tiles.append((i, min(i + tile[0], resolution[0]), \
+                j, min(j + tile[1], resolution[1])))
+    return tiles
+
+
+def tile_path(checkpoint, bounds):
+    """
+    Returns: str; path of the checkpoint of the tile with bounds
+    """
+    return os.path.join(checkpoint, "{}_{}_{}_{}.npy".format(*bounds))
+
+
+def save_tile(checkpoint, bounds, result):
+    """
+    Saves the result of one tile to the checkpoint directory, the file only
+    appears once it is complete
+    """
+    path = tile_path(checkpoint, bounds)
+    np.save(path + ".tmp.npy", result)
+    os.replace(path + ".tmp.npy", path)
+
+
+def run_tile(kernel, in_handles, out_handle, bounds, args, checkpoint=None):
+    """
+    Runs kernel over one tile of the shared input arrays and writes the result
+    into the shared output array. This is executed by the worker processes.
+    """
+    attached = [ss.attach_array(handle) for handle in in_handles]
+    out, out_segment = ss.attach_array(out_handle)
+    i0, i1, j0, j1 = bounds
+    try:
+        out[..., i0:i1, j0:j1] = kernel(\
+            *[arr[..., i0:i1, j0:j1] for arr, _ in attached], *args)
+        if checkpoint != None:
+            save_tile(checkpoint, bounds, out[..., i0:i1, j0:j1])
+    finally:
+        # Views must be released before the segments can be closed
+        segments = [segment for _, segment in attached] + [out_segment]
+        del attached, out
+        for segment in segments:
+            if segment is not None:
+                segment.close()
+
+
+def run_tiles(kernel, arrays, resolution, out_shape=(), args=(), \
+    tile=DEFAULT_TILE, workers=None, dtype=np.float64, checkpoint=None):
+    """
+    Runs a per-pixel kernel over the sensor one tile at a time in a process
+    pool. The input arrays are shared with the workers through their memory
+    map or shared memory rather than pickled, and each worker writes its tile
+    of the result straight into a shared output array.
+
+    Args:
+        kernel: function, called as kernel(*tiles, *args) where tiles are the
+            [..., rows, columns] tiles of arrays. It must return an array of
+            shape [*out_shape, rows, columns] and be importable by the
+            workers, i.e. defined at module level
+
+        arrays: array-like, collection of arrays whose last two dimensions
+            are the sensor resolution, arrays published with
+            shared_store.SharedArray are attached rather than shared again
+
+        resolution: array-like, resolution of the sensor
+
+        out_shape: tuple, leading dimensions of the result of each pixel
+
+        args: tuple, extra arguments passed to kernel
+
+        tile: array-like, (rows, columns) of each tile
+
+        workers: int, number of worker processes. If None then one per cpu
+            is used, if 1 then the tiles are run in this process
+
+        dtype: data type of the result
+
+        checkpoint: str, directory the result of each tile is saved to as it
+            finishes. Tiles already saved there are loaded instead of being
+            run again, so an interrupted call resumes where it stopped. The
+            directory must be unique to the inputs and arguments and is
+            removed once every tile is done
+
+    Returns: [*out_shape, *resolution] np.ndarray of the combined results
+    """
+    if workers == None:
+        workers = os.cpu_count()
+    tiles = get_tiles(resolution, tile=tile)
+    out = np.zeros([*out_shape, *resolution], dtype=dtype)
+    if checkpoint != None:
+        os.makedirs(checkpoint, exist_ok=True)
+        remaining = []
+        for bounds in tiles:
+            i0, i1, j0, j1 = bounds
+            try:
+                out[..., i0:i1, j0:j1] = np.load(tile_path(checkpoint, bounds))
+            except (OSError, ValueError):
+                remaining.append(bounds)
+        if len(remaining) < len(tiles):
+            print("Resuming from {} of {} checkpointed tiles in \"{}\""\
+                .format(len(tiles) - len(remaining), len(tiles), checkpoint))
+        tiles = remaining
+    if workers == 1:
+        arrays = [arr.array() if isinstance(arr, ss.SharedArray) else arr \
+            for arr in arrays]
+        for bounds in tiles:
+            i0, i1, j0, j1 = bounds
+            out[..., i0:i1, j0:j1] = kernel(\
+                *[arr[..., i0:i1, j0:j1] for arr in arrays], *args)
+            if checkpoint != None:
+                save_tile(checkpoint, bounds, out[..., i0:i1, j0:j1])
+    else:
+        run_pool(kernel, arrays, out, tiles, args, workers, checkpoint)
+    if checkpoint != None:
+        shutil.rmtree(checkpoint, ignore_errors=True)
+    return out
+
+
+def run_pool(kernel, arrays, out, tiles, args, workers, checkpoint):
+    """
+    Runs the tiles of run_tiles in a process pool, writing the results into
+    out
+    """
+    segments = []
+    try:
+        in_handles = []
+        for arr in arrays:
+            handle, segment = ss.share_array(arr)
+            in_handles.append(handle)
+            segments.append(segment)
+        out_handle, out_segment = ss.share_array(out)
+        segments.append(out_segment)
+        with ProcessPoolExecutor(max_workers=workers, \
+            mp_context=ss.pool_context()) as pool:
+            futures = [pool.submit(run_tile, kernel, in_handles, out_handle, \
+                bounds, args, checkpoint) for bounds in tiles]
+            for future in futures:
+                future.result()
+        shared_out = np.ndarray(out.shape, dtype=out.dtype, \
+            buffer=out_segment.buf)
+        out[...] = shared_out
+        del shared_out
+    finally:
+        for segment in segments:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
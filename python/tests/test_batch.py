@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import batch
+
+
+def test_job_lock_excludes_and_releases(tmp_path):
+    first = batch.JobLock(str(tmp_path))
+    second = batch.JobLock(str(tmp_path))
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    assert second.owned()
+    second.release()
+    assert not os.path.exists(os.path.join(str(tmp_path), batch.LOCK_NAME))
+
+
+def test_job_lock_stale_takeover(tmp_path):
+    first = batch.JobLock(str(tmp_path), stale_after=60)
+    second = batch.JobLock(str(tmp_path), stale_after=60)
+    assert first.acquire()
+    # The first owner died long ago
+    first.stop.set()
+    first.thread.join()
+    past = time.time() - 3600
+    os.utime(first.path, (past, past))
+    assert second.acquire()
+    assert second.owned() and not first.owned()
+    # The old owner releasing late must not remove the new lock
+    first.release()
+    assert second.owned()
+    second.release()
+    assert os.listdir(str(tmp_path)) == []
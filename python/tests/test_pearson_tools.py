@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pearson_tools as pt
+
+
+def test_merge_bins_groups_hold_min_expected():
+    expected = np.array([0.1, 0.2, 3, 10, 20, 10, 3, 1, 0.5, \
+        1, 4, 6, 2, 6, 1, \
+        0, 0, 0])
+    pix = np.repeat([0, 1, 2], [9, 6, 3])
+    start = np.array([0, 9, 15, 18])
+    group, n_groups = pt.merge_bins(expected, pix, start)
+    assert np.array_equal(group, \
+        [0, 0, 0, 0, 1, 2, 2, 2, 2, 3, 3, 4, 5, 5, 5, 6, 6, 6])
+    assert n_groups == 7
+    sums = np.bincount(group, weights=expected)
+    assert np.all(sums[:-1] >= pt.MIN_EXPECTED)
+
+
+def test_gaussian_p_values_uniform():
+    rng = np.random.default_rng(0)
+    block = np.rint(rng.normal(300, 4, (200, 5000))).astype(np.uint16)
+    chi2, p_val = pt.Pearsontest().test_block(block, 1)
+    assert np.isfinite(p_val).all()
+    assert abs(np.mean(p_val < 0.05) - 0.05) < 0.015
+    # A uniform pixel is clearly not gaussian
+    block = rng.integers(0, 30, (2000, 20)).astype(np.uint16)
+    chi2, p_val = pt.Pearsontest().test_block(block, 1)
+    assert np.all(p_val < 1e-3)
+
+
+def test_histogram_accumulator_chunked_matches_whole():
+    rng = np.random.default_rng(1)
+    frames = np.rint(rng.normal(500, 3, (300, 4, 5))).astype(np.uint16)
+    frames[7, 0, 0] = 900
+    center = np.median(frames, axis=0)
+    whole = pt.HistogramAccumulator((4, 5), center=center)
+    whole.update(frames)
+    first = pt.HistogramAccumulator((4, 5), center=center)
+    second = pt.HistogramAccumulator((4, 5), center=center)
+    for i in range(0, 150, 40):
+        first.update(frames[i:min(i + 40, 150)])
+    second.update(frames[150:])
+    first.merge(second)
+    assert np.array_equal(first.counts, whole.counts)
+    assert whole.over[0] == 1 and whole.over.sum() == 1
+    assert whole.counts.sum() + whole.under.sum() + whole.over.sum() \
+        == frames.size
+    result = first.result()
+    assert result.shape == (2, 4, 5)
+    assert np.array_equal(result, whole.result())
+    assert np.isfinite(result[1, 1:]).all()
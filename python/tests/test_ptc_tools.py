@@ -0,0 +1,28 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import ptc_tools as pt
+
+
+def test_add_layers_updates_order():
+    # Ties are common in real data, new runs go after equal old runs
+    rng = np.random.default_rng(0)
+    resolution = (3, 4)
+    s_mean = rng.integers(0, 5, (9, *resolution)).astype(float)
+    err_tot = rng.random((9, *resolution))
+    ptc = pt.PTC(0, resolution, True)
+    ptc.add_layers(s_mean[:4], err_tot[:4], ["a", "b", "c", "d"])
+    ptc.index_sort(np.argsort(ptc.s_mean, axis=0, kind="stable"), axis=0)
+    ptc.add_layers(s_mean[4:6], err_tot[4:6], ["e", "f"])
+    ptc.add_layers(s_mean[6:], err_tot[6:], ["g", "h", "i"])
+    order = np.argsort(s_mean, axis=0, kind="stable")
+    assert np.array_equal(ptc.order, order)
+    assert np.array_equal(ptc.s_mean, s_mean)
+    assert ptc.sources == list("abcdefghi")
+    sorted_err = np.take_along_axis(err_tot, order, axis=0)
+    assert np.array_equal(ptc.view("err_tot")[:], sorted_err)
+    assert np.array_equal(ptc.view("err_tot")[:, 1, 2], sorted_err[:, 1, 2])
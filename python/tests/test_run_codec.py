@@ -0,0 +1,47 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import run_codec as rc
+
+
+def write_raw(filepath, n_frames, resolution, tail=b""):
+    rng = np.random.default_rng(0)
+    frames = rng.normal(1000, 20, (n_frames, resolution[0]*resolution[1] \
+        + 2)).astype(np.uint16)
+    with open(filepath, "wb") as f:
+        f.write(frames.tobytes())
+        f.write(tail)
+    return frames
+
+
+def test_encode_decode_round_trip(tmp_path):
+    # Partial last chunk and trailing bytes must both survive
+    raw_path = str(tmp_path / "run_1.raw")
+    write_raw(raw_path, 21, (6, 5), tail=b"\x01\x02\x03")
+    out_path = rc.encode_run(raw_path, (6, 5), chunk=8)
+    assert out_path == str(tmp_path / "run_1.rawz")
+    assert rc.is_compressed(out_path) and not rc.is_compressed(raw_path)
+    restored = str(tmp_path / "restored.raw")
+    rc.decode_run(out_path, restored)
+    with open(raw_path, "rb") as a, open(restored, "rb") as b:
+        assert a.read() == b.read()
+
+
+def test_compressed_run_indexing(tmp_path):
+    raw_path = str(tmp_path / "run_1.raw")
+    frames = write_raw(raw_path, 21, (6, 5))
+    data = frames[1:, 2:].reshape(-1, 6, 5)
+    run = rc.CompressedRun(rc.encode_run(raw_path, (6, 5), chunk=8))
+    assert run.shape == data.shape
+    assert np.array_equal(np.asarray(run), data)
+    view = run[3:17:2]
+    assert view.shape == data[3:17:2].shape
+    assert np.array_equal(np.asarray(view), data[3:17:2])
+    assert np.array_equal(run[5], data[5])
+    assert np.array_equal(run[[19, 0, 8]], data[[19, 0, 8]])
+    assert np.array_equal(run[2:18, 1:4, 2], data[2:18, 1:4, 2])
+    assert np.array_equal(run[..., 1:3, :], data[..., 1:3, :])
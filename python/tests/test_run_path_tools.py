@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import run_path_tools as rpt
+
+
+def touch(dirpath, filename):
+    with open(os.path.join(dirpath, filename), "wb"):
+        pass
+
+
+def test_find_run_files_raw_and_compressed(tmp_path):
+    # A run kept both raw and compressed is a single run
+    for filename in ("lvl_1.raw", "lvl_1.rawz", "lvl_2.rawz", "lvl_10.raw", \
+        "lvl_1.raw.stats.npz"):
+        touch(tmp_path, filename)
+    filepaths = rpt.find_run_files(str(tmp_path), "lvl")
+    assert [os.path.basename(path) for path in filepaths] == \
+        ["lvl_1.raw", "lvl_2.rawz", "lvl_10.raw"]
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import stats_cache as sc
+
+
+def test_run_stats_chunk_independent():
+    # Chunking and threads must not change a single bit of the result
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 2**16, (50, 4, 3), dtype=np.uint16)
+    ref = sc.compute_run_stats(arr, (0, None, 1), chunk=50)
+    for chunk, workers in ((1, 1), (7, 1), (64, 3), (5, 4)):
+        stats = sc.compute_run_stats(arr, (0, None, 1), chunk=chunk, \
+            workers=workers)
+        assert stats.n_frames == ref.n_frames
+        for name in ("sum", "sumsq", "min", "max", "frame_mean"):
+            assert np.array_equal(getattr(stats, name), getattr(ref, name))
+        assert np.array_equal(stats.var(ddof=1), ref.var(ddof=1))
+    values = arr.astype(np.float64)
+    assert np.allclose(ref.mean(), values.mean(axis=0))
+    assert np.allclose(ref.var(ddof=1), values.var(axis=0, ddof=1))
+    assert np.array_equal(ref.min, arr.min(axis=0))
+    assert np.array_equal(ref.max, arr.max(axis=0))